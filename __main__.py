@@ -38,12 +38,13 @@ init_colorit()
 
 # import classes
 from archivist.classes.Archivist import Archivist as a
-from archivist.classes.Downloader import Downloader
 
 # import functions
 from archivist.messenger.email import send_email
 from archivist.messenger.pushover import pushover
 from archivist.utils.common import get_datetime
+from archivist.utils.scheduler import plan_downloads, run_downloads
+from archivist.utils.retrieve import fetch_file
 
 # run module as script
 a.t = get_datetime(ignore_fake_datetime=True).strftime("%Y-%m-%d %H:%M:%S %Z") # record start time
@@ -70,9 +71,9 @@ if a.options["mode"] == "prod" or a.options["mode"] == "test":
             sys.exit()
     # announce beginning of file downloads
     print('Beginning file downloads...')
-    # loop through datasets
-    for uuid in a.ds:
-        Downloader(uuid)
+    # download datasets
+    uuids = plan_downloads(list(a.ds), workers=a.options["workers"])
+    run_downloads(uuids, workers=a.options["workers"])
     # upload updated index
     if a.options["mode"] == "prod":
         try:
@@ -93,6 +94,8 @@ if a.options["mode"] == "prod" or a.options["mode"] == "test":
                 pushover(notif, priority=1, title = a.config["project"]["title"] + " update failed")
     # summarize successes and failures
     a.print_success_failure()
+    # summarize connection reuse
+    a.print_http_stats()
     # print rerun code, if necessary
     if a.log["failure"] > 0:
         # print names of failed datasets
@@ -144,7 +147,19 @@ if a.options["mode"] == "prod" or a.options["mode"] == "test":
 elif a.options["mode"] == "index":
     ind = a.create_index()
     a.write_index(ind, out_path=a.options["out_path"])
+elif a.options["mode"] == "fetch":
+    a.download_index()
+    try:
+        fetch_file(a.options["file_name"], uuid = a.options["uuid"], out_path = a.options["out_path"])
+    finally:
+        a.close_index()
+elif a.options["mode"] == "compile_catalog":
+    a.compile_catalog()
+elif a.options["mode"] == "stitch_log":
+    a.stitch_log(out_path = a.options["out_path"], since = a.options["since"])
+elif a.options["mode"] == "compact_index":
+    a.compact_index()
 elif a.options["mode"] == "initialize_index":
-    a.initialize_index(archive_dir = a.options["archive_dir"], out_path = a.options["out_path"])
+    a.initialize_index(archive_dir = a.options["archive_dir"], out_path = a.options["out_path"], incremental = a.options["incremental"], from_s3 = a.options["from_s3"])
 else:
     sys.exit("Please select a valid run mode.")
@@ -0,0 +1,58 @@
+# import modules
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+# benchmark startup time of archivist
+# usage: python bench/import_time.py [project_dir] [-m MODULE] [-n REPEAT] [-t TOP]
+# modules are imported in a fresh interpreter with python -X importtime, as for a test run
+# (archivist must be installed, e.g., using pip install -e)
+
+def parse_importtime(stderr):
+    """Parse the output of python -X importtime.
+
+    Returns:
+    list: Tuples of cumulative import time (microseconds) and module name.
+    """
+    times = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        # nested imports are indented
+        times.append((int(cumulative), module[1:].rstrip()))
+    return times
+
+def run_import(module, project_dir):
+    # archivist parses arguments and loads the project when it is first imported
+    code = "import sys; sys.argv = ['archivist', 'test', " + repr(project_dir) + "]; import " + module
+    t0 = time.monotonic()
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    elapsed = time.monotonic() - t0
+    if p.returncode != 0:
+        print(p.stderr[-2000:])
+        sys.exit("Import of " + module + " failed.")
+    return elapsed, parse_importtime(p.stderr)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("project_dir", nargs = "?", default = os.getcwd(), help = "Path to the project directory (defaults to the working directory)")
+    parser.add_argument("-m", "--module", default = "archivist.classes.Downloader", help = "Module to import (defaults to archivist.classes.Downloader)")
+    parser.add_argument("-n", "--repeat", type = int, default = 5, help = "Number of runs (defaults to 5)")
+    parser.add_argument("-t", "--top", type = int, default = 15, help = "Number of slowest top-level imports to show (defaults to 15)")
+    args = parser.parse_args()
+    # run imports
+    runs = [run_import(args.module, args.project_dir) for _ in range(args.repeat)]
+    wall = sorted(r[0] for r in runs)
+    print("Startup time (" + str(args.repeat) + " runs): min " + "%.3f" % wall[0] + " s, median " + "%.3f" % wall[len(wall) // 2] + " s")
+    # show slowest top-level imports from the fastest run
+    times = min(runs, key = lambda r: r[0])[1]
+    top = sorted(((t, m) for t, m in times if not m.startswith(" ")), reverse = True)
+    print("Slowest imports (cumulative):")
+    for t, m in top[:args.top]:
+        print("%10.1f ms  %s" % (t / 1000, m))
+
+if __name__ == "__main__":
+    main()
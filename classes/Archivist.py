@@ -1,17 +1,32 @@
 # import modules
 import argparse
+import sys
 import os
 import json
 import toml
 import random
 import tempfile
 from colorit import *
-import pandas as pd
-import boto3
-import re
 import time
-import hashlib
-import sqlite_utils
+from datetime import datetime
+import gzip
+import fcntl
+import glob
+import shutil
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from humanfriendly import format_size
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# import functions
+from archivist.utils.http import new_session, session_stats
+from archivist.utils.compiled import compile_cached
+from archivist.utils.catalog import compile_catalog, load_catalog
+from archivist.utils.hashing import CHUNK_SIZE, md5_chunks
+from archivist.utils.indexing import MD5_RE, hash_file, index_rows, mark_duplicates, changeset_name, pending_changesets, folded_changesets
+from archivist.utils.storage import open_decompressed
 
 # parse arguments
 def arg_parser():
@@ -28,7 +43,11 @@ def arg_parser():
     parser_prod.add_argument("-n", "--notify", required = False, action = "store_true", dest = "notify", help = "If present, a Pushover notification will be sent at the end of a prod run (prod only)")
     parser_prod.add_argument("-l", "--upload-log", required = False, action = "store_true", dest = "upload_log", help = "If present, the log of the run will be uploaded to the S3 bucket (prod only)")
     parser_prod.add_argument("-i", "--allow-inactive", required = False, action = "store_true", dest = "allow_inactive", help = "If present, datasets marked as inactive will not be skipped")
-    parser_prod.add_argument("-r", "--random-order", required = False, action = "store_true", dest = "random_order", help = "If present, datasets will be downloaded in a random order")
+    parser_prod.add_argument("--order", choices = ["listed", "random", "history"], default = "listed", required = False, help = "Order in which datasets are downloaded: as listed in datasets.json (the default), random or based on the history of previous runs (prod only: longest and least reliable datasets first, spread across hosts)")
+    parser_prod.add_argument("-r", "--random-order", required = False, action = "store_const", const = "random", dest = "order", help = "Same as --order random")
+    parser_prod.add_argument("-w", "--workers", type = int, default = 1, required = False, help = "Number of datasets to download in parallel (defaults to 1)")
+    parser_prod.add_argument("-s", "--skip-unchanged", required = False, action = "store_true", dest = "skip_unchanged", help = "If present, datasets that are unlikely to have changed since they were last downloaded will be skipped, based on how often they changed in the past (prod only, ignored when --uuid is set)")
+    parser_prod.add_argument("-p", "--prefetch", required = False, action = "store_true", help = "If present, dynamic URLs (url_fun_python) will be resolved concurrently before downloads begin")
     parser_prod.add_argument("-t", "--fake-datetime", required = False, dest = "fake_datetime", help = "If present, the specified datetime will be used for all files instead of the current datetime (format: YYYY-MM-DD_HH-MM)")
     parser_prod.add_argument("-d", "--debug", nargs = "+", choices = ["print-md5", "ignore-ssl", "force-ssl", "no-upload"], required = False, help = "Optional debug parameters")
     # subparser for mode "test"
@@ -40,20 +59,57 @@ def arg_parser():
     parser_test.add_argument("-n", "--notify", required = False, action = "store_true", dest = "notify", help = "If present, a Pushover notification will be sent at the end of a prod run (prod only)")
     parser_test.add_argument("-l", "--upload-log", required = False, action = "store_true", dest = "upload_log", help = "If present, the log of the run will be uploaded to the S3 bucket (prod only)")
     parser_test.add_argument("-i", "--allow-inactive", required = False, action = "store_true", dest = "allow_inactive", help = "If present, datasets marked as inactive will not be skipped")
-    parser_test.add_argument("-r", "--random-order", required = False, action = "store_true", dest = "random_order", help = "If present, datasets will be downloaded in a random order")
+    parser_test.add_argument("--order", choices = ["listed", "random", "history"], default = "listed", required = False, help = "Order in which datasets are downloaded: as listed in datasets.json (the default), random or based on the history of previous runs (prod only: longest and least reliable datasets first, spread across hosts)")
+    parser_test.add_argument("-r", "--random-order", required = False, action = "store_const", const = "random", dest = "order", help = "Same as --order random")
+    parser_test.add_argument("-w", "--workers", type = int, default = 1, required = False, help = "Number of datasets to download in parallel (defaults to 1)")
+    parser_test.add_argument("-s", "--skip-unchanged", required = False, action = "store_true", dest = "skip_unchanged", help = "If present, datasets that are unlikely to have changed since they were last downloaded will be skipped, based on how often they changed in the past (prod only, ignored when --uuid is set)")
+    parser_test.add_argument("-p", "--prefetch", required = False, action = "store_true", help = "If present, dynamic URLs (url_fun_python) will be resolved concurrently before downloads begin")
     parser_test.add_argument("-t", "--fake-datetime", required = False, dest = "fake_datetime", help = "If present, the specified datetime will be used for all files instead of the current datetime (format: YYYY-MM-DD_HH-MM)")
     parser_test.add_argument("-d", "--debug", nargs = "+", choices = ["print-md5", "ignore-ssl", "force-ssl"], required = False, help = "Optional debug parameters")
     # subparser for mode "initialize_index"
     parser_initialize_index = subparsers.add_parser("initialize_index")
-    parser_initialize_index.add_argument("archive_dir", help = "Path to local mirror of S3 bucket")
+    parser_initialize_index.add_argument("archive_dir", help = "Path to local mirror of S3 bucket (with --from-s3, only used as the default output directory; a local mirror cannot be used if any option in the [storage] section of config.toml is enabled)")
     parser_initialize_index.add_argument("project_dir", nargs = "?", default = os.getcwd(), help = "Path to the project directory (defaults to the working directory)")
     parser_initialize_index.add_argument("-d", "--debug", nargs = "+", choices = [], required = False, help = "Optional debug parameters (none currently available)")
     parser_initialize_index.add_argument("-o", "--out-path", nargs = None, required = False, help = "Output file name and path (if blank, default file name and path is used)")
+    parser_initialize_index.add_argument("--from-s3", required = False, action = "store_true", dest = "from_s3", help = "If present, build the index from a listing of the S3 bucket instead of a local mirror (compressed and delta objects are hashed using the original MD5 hash and size recorded in their metadata; not available if content-addressed storage or bundles are used)")
+    parser_initialize_index.add_argument("--incremental", required = False, action = "store_true", dest = "incremental", help = "If present, update an existing index, hashing only new or changed files")
+    parser_initialize_index.add_argument("-w", "--workers", type = int, default = os.cpu_count(), required = False, help = "Number of processes used to hash files (defaults to the number of CPUs)")
+    # subparser for mode "compact_index"
+    parser_compact_index = subparsers.add_parser("compact_index")
+    parser_compact_index.add_argument("project_dir", nargs = "?", default = os.getcwd(), help = "Path to the project directory (defaults to the working directory)")
+    parser_compact_index.add_argument("-d", "--debug", nargs = "+", choices = ["no-upload"], required = False, help = "Optional debug parameters")
+    # subparser for mode "compile_catalog"
+    parser_compile_catalog = subparsers.add_parser("compile_catalog")
+    parser_compile_catalog.add_argument("project_dir", nargs = "?", default = os.getcwd(), help = "Path to the project directory (defaults to the working directory)")
+    parser_compile_catalog.add_argument("-d", "--debug", nargs = "+", choices = [], required = False, help = "Optional debug parameters (none currently available)")
+    # subparser for mode "stitch_log"
+    parser_stitch_log = subparsers.add_parser("stitch_log")
+    parser_stitch_log.add_argument("project_dir", nargs = "?", default = os.getcwd(), help = "Path to the project directory (defaults to the working directory)")
+    parser_stitch_log.add_argument("-o", "--out-path", nargs = None, required = False, help = "Output file name and path (defaults to log.txt in the project directory)")
+    parser_stitch_log.add_argument("-s", "--since", required = False, help = "If present, only logs of runs on or after this date are included (format: YYYY-MM-DD)")
+    parser_stitch_log.add_argument("-d", "--debug", nargs = "+", choices = [], required = False, help = "Optional debug parameters (none currently available)")
+    # subparser for mode "fetch"
+    parser_fetch = subparsers.add_parser("fetch")
+    parser_fetch.add_argument("file_name", help = "Name of the archived file (as recorded in the index)")
+    parser_fetch.add_argument("project_dir", nargs = "?", default = os.getcwd(), help = "Path to the project directory (defaults to the working directory)")
+    parser_fetch.add_argument("-u", "--uuid", required = False, help = "UUID of the dataset (if the file name is not unique)")
+    parser_fetch.add_argument("-o", "--out-path", nargs = None, required = False, help = "Output file name and path (defaults to the file name in the working directory)")
+    parser_fetch.add_argument("-d", "--debug", nargs = "+", choices = [], required = False, help = "Optional debug parameters (none currently available)")
     # parse args
     args = parser.parse_args()
     # return parsed args
     return args
 
+# columns of the archive table describing where the stored copy of a file is
+# (file_key: S3 key relative to the bucket root, if not stored at its original path;
+# file_base: name of the version a delta applies to, if stored as a delta;
+# file_chain: number of deltas between this version and the last full version;
+# file_encoding: compression method of the stored copy, if compressed;
+# file_stored_size: size of the stored copy in bytes;
+# file_offset: byte offset of the stored copy, if stored in a bundle with other files)
+STORAGE_COLUMNS = {"file_key": str, "file_base": str, "file_chain": int, "file_encoding": str, "file_stored_size": int, "file_offset": int}
+
 # define Archivist class
 class Archivist:
     def __init__(self):
@@ -68,13 +124,16 @@ class Archivist:
                 "uuid": args.uuid,
                 "uuid_exclude": args.uuid_exclude,
                 "allow_inactive": args.allow_inactive,
-                "random_order": args.random_order,
+                "order": args.order,
+                "workers": max(args.workers, 1),
+                "prefetch": args.prefetch,
+                "skip_unchanged": args.skip_unchanged,
                 "fake_datetime": args.fake_datetime
             }
             # process fake_datetime
             if self.options["fake_datetime"]:
                 try:
-                    self.options["fake_datetime"] = pd.to_datetime(self.options["fake_datetime"], format="%Y-%m-%d_%H-%M")
+                    self.options["fake_datetime"] = datetime.strptime(self.options["fake_datetime"], "%Y-%m-%d_%H-%M")
                     print("Fake datetime was specified: " + self.options["fake_datetime"].strftime("%Y-%m-%d %H:%M") + ". Using this datetime for all files...")
                 except:
                     print("Invalid fake datetime was specified: " + self.options["fake_datetime"] +  ". Ignoring...")
@@ -85,8 +144,37 @@ class Archivist:
                 "archive_dir": args.archive_dir,
                 "project_dir": args.project_dir,
                 "out_path": args.out_path,
+                "workers": max(args.workers or 1, 1),
+                "incremental": args.incremental,
+                "from_s3": args.from_s3,
+                "allow_inactive": True # option for self.load_ds()
+            }
+        elif args.mode == "compact_index":
+            self.options = {
+                "mode": args.mode,
+                "project_dir": args.project_dir
+            }
+        elif args.mode == "fetch":
+            self.options = {
+                "mode": args.mode,
+                "project_dir": args.project_dir,
+                "file_name": args.file_name,
+                "uuid": args.uuid,
+                "out_path": args.out_path,
                 "allow_inactive": True # option for self.load_ds()
             }
+        elif args.mode == "compile_catalog":
+            self.options = {
+                "mode": args.mode,
+                "project_dir": args.project_dir
+            }
+        elif args.mode == "stitch_log":
+            self.options = {
+                "mode": args.mode,
+                "project_dir": args.project_dir,
+                "out_path": args.out_path,
+                "since": args.since
+            }
         # set log options and initialize log (for prod and test modes)
         if args.mode == "prod" or args.mode == "test":
             self.log_options = {
@@ -99,8 +187,23 @@ class Archivist:
                 "log": "",
                 "success": 0,
                 "failure": 0,
-                "failure_uuid": []
+                "failure_uuid": [],
+                "skipped": 0
             }
+        # locks for state shared between download workers
+        self.log_lock = threading.Lock()
+        self.index_lock = threading.RLock()
+        self.host_lock = threading.Lock()
+        self.host_semaphores = {}
+        # identifies the files of this run, such as its index journal (process ID and start time)
+        self.run_id = str(os.getpid()) + "." + time.strftime("%Y%m%d%H%M%S")
+        # keep-alive HTTP sessions shared by all downloads, keyed by (host, verify, legacy_ssl)
+        self.session_lock = threading.Lock()
+        self.sessions = {}
+        # dynamic URLs resolved before downloads begin (--prefetch), keyed by UUID
+        self.resolved_urls = {}
+        # events set when the resolution of a dynamic URL from --prefetch ends, keyed by UUID
+        self.prefetching = {}
         # set debug options to empty list if not given
         if args.debug is None:
             args.debug = []
@@ -115,12 +218,18 @@ class Archivist:
         # load config
         with open(os.path.join(self.options["project_dir"], "config.toml")) as config_file:
             self.config = toml.load(config_file)
-        # load datasets.json
-        with open(os.path.join(self.options["project_dir"], "datasets.json")) as json_file:
-            self.ds_raw = json.load(json_file)
-        # process datasets.json (for prod, test, initialize_index modes)
-        if self.options["mode"] == "prod" or self.options["mode"] == "test" or self.options["mode"] == "initialize_index":
+        # load datasets.json from the precompiled catalog and process it (for prod, test, initialize_index, fetch modes)
+        if self.options["mode"] in ["prod", "test", "initialize_index", "fetch"]:
+            self.catalog, recompiled = load_catalog(self.catalog_path(), self.catalog_cache_path())
+            if recompiled:
+                print("datasets.json has changed. Recompiled dataset catalog.")
+            if len(self.catalog["warnings"]) > 0:
+                print(background(str(len(self.catalog["warnings"])) + " datasets have invalid entries (run compile_catalog for details).", Colors.red))
             self.ds = self.load_ds()
+        # compile dataset code, reporting syntax errors before the run starts (for prod, test modes)
+        self.proc_webdriver = {}
+        if self.options["mode"] in ["prod", "test"]:
+            self.compile_ds_code()
         # set S3 options:
         self.s3 = {
             "aws_id": os.environ["AWS_ID"],
@@ -129,8 +238,8 @@ class Archivist:
             "bucket_root": os.environ["S3_ROOT"],
             "bucket_url": os.environ["S3_URL"]
         }
-        # connect to S3 bucket (for prod mode)
-        if self.options["mode"] == "prod":
+        # connect to S3 bucket (for prod, compact_index and stitch_log modes and initialize_index --from-s3)
+        if self.options["mode"] in ["prod", "compact_index", "stitch_log", "fetch"] or self.options.get("from_s3"):
             self.s3["bucket"] = self.connect_s3(
                 s3_bucket = self.s3["bucket_name"],
                 aws_id = self.s3["aws_id"],
@@ -143,6 +252,12 @@ class Archivist:
                 print("No email will be sent at the end of this run.")
             if self.debug_options["print_md5"]:
                 print("DEBUG: MD5 hashes will be printed for each downloaded dataset.")
+            if self.options["workers"] > 1:
+                print("Datasets will be downloaded using " + str(self.options["workers"]) + " workers.")
+            if self.options["prefetch"]:
+                print("Dynamic URLs will be resolved before downloads begin.")
+            if self.options["skip_unchanged"]:
+                print("Datasets that are unlikely to have changed will be skipped.")
             if self.options["mode"] == "prod":
                 if self.log_options["notify"]:
                     print("A notification will be sent at the end of this run.")
@@ -155,17 +270,72 @@ class Archivist:
         
     # define methods
     def record_success(self, f_name):
-        self.log["success"] += 1
-        self.log["log"] += 'SUCCESS: ' + f_name + '\n'
-        print(background('SUCCESS: ' + f_name, Colors.blue))
+        with self.log_lock:
+            self.log["success"] += 1
+            self.log["log"] += 'SUCCESS: ' + f_name + '\n'
+            print(background('SUCCESS: ' + f_name, Colors.blue))
     
     def record_failure(self, f_name, uuid):
-        self.log["failure"] += 1
-        self.log["log"] += 'FAILURE: ' + f_name + '\n'
-        self.log["failure_uuid"].append(uuid)
-        print(background('FAILURE: ' + f_name, Colors.red))
+        with self.log_lock:
+            self.log["failure"] += 1
+            self.log["log"] += 'FAILURE: ' + f_name + '\n'
+            self.log["failure_uuid"].append(uuid)
+            print(background('FAILURE: ' + f_name, Colors.red))
+
+    def record_skip(self, uuid, reason):
+        with self.log_lock:
+            self.log["skipped"] += 1
+            self.log["log"] += 'SKIPPED: ' + uuid + ' (' + reason + ')\n'
+            print(background('SKIPPED: ' + uuid + ' (' + reason + ')', Colors.orange))
+
+    @contextmanager
+    def host_limit(self, url):
+        """Limit the number of parallel requests to the host of a URL.
+
+        The limit is set by max_per_host in the [downloading] section of config.toml (0 for no limit).
+        """
+        host = urlparse(url).hostname
+        max_per_host = self.config["downloading"].get("max_per_host", 0)
+        if host is None or max_per_host <= 0:
+            yield
+            return
+        # get semaphore for host, creating it if necessary
+        with self.host_lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(max_per_host)
+            sem = self.host_semaphores[host]
+        with sem:
+            yield
+
+    def get_session(self, url, verify = True, legacy_ssl = False):
+        """Get the shared keep-alive session for the host of a URL, creating it if necessary.
+
+        The number of connections kept open per host is set by pool_maxsize in the [downloading] section of config.toml.
+        """
+        key = (urlparse(url).hostname, verify, legacy_ssl)
+        with self.session_lock:
+            if key not in self.sessions:
+                pool_maxsize = self.config["downloading"].get("pool_maxsize", 10)
+                self.sessions[key] = new_session(verify=verify, legacy_ssl=legacy_ssl, pool_maxsize=pool_maxsize)
+            return self.sessions[key]
+
+    def http_stats(self):
+        # count requests and new connections across all sessions
+        n_requests = 0
+        n_connections = 0
+        with self.session_lock:
+            for session in self.sessions.values():
+                r, c = session_stats(session)
+                n_requests += r
+                n_connections += c
+        return {"sessions": len(self.sessions), "requests": n_requests, "connections": n_connections, "reused": max(n_requests - n_connections, 0)}
+
+    def print_http_stats(self):
+        stats = self.http_stats()
+        print("HTTP requests: " + str(stats["requests"]) + " (" + str(stats["connections"]) + " new connections, " + str(stats["reused"]) + " reused, " + str(stats["sessions"]) + " sessions)")
 
     def connect_s3(self, s3_bucket, aws_id, aws_key):
+        import boto3 # imported here to keep startup fast for runs that do not use S3
         try:
             aws = boto3.Session(
                 aws_access_key_id = aws_id,
@@ -177,24 +347,35 @@ class Archivist:
             print(e)
             sys.exit("Failed to connect to S3 bucket.")
 
+    def catalog_path(self):
+        return os.path.join(self.options["project_dir"], "datasets.json")
+
+    def catalog_cache_path(self):
+        # precompiled catalog of datasets.json (see utils.catalog)
+        return os.path.join(self.options["project_dir"], ".datasets_catalog")
+
+    def compile_catalog(self):
+        """Validate datasets.json and write the precompiled catalog used by later runs."""
+        catalog = compile_catalog(self.catalog_path(), self.catalog_cache_path())
+        self.catalog = catalog
+        print("Compiled " + str(len(catalog["ds"])) + " datasets (" + str(len(catalog["active"])) + " active) to: " + self.catalog_cache_path())
+        self.print_catalog_warnings()
+
+    def print_catalog_warnings(self):
+        for uuid, warnings in self.catalog["warnings"].items():
+            for w in warnings:
+                print(background(uuid + ": " + w, Colors.red))
+
     def load_ds(self):
-        # load datasets and convert to single dictionary
-        ds = {}
+        # get datasets from the catalog (a single dictionary keyed by UUID)
         if (self.options["allow_inactive"]):
             # active and inactive datasets
-            datasets = self.ds_raw
-            for a in datasets:
-                for d in datasets[a].keys():
-                    for i in range(len(datasets[a][d])):
-                        ds[datasets[a][d][i]['uuid']] = datasets[a][d][i]
+            ds = dict(self.catalog["ds"])
         else:
             # active datasets only
-            datasets = self.ds_raw["active"]
-            for d in datasets:
-                for i in range(len(datasets[d])):
-                    ds[datasets[d][i]['uuid']] = datasets[d][i]
-        if self.options["mode"] == "initialize_index":
-            # if mode == initialize_index, return ds
+            ds = {uuid: self.catalog["ds"][uuid] for uuid in self.catalog["active"]}
+        if self.options["mode"] == "initialize_index" or self.options["mode"] == "fetch":
+            # if mode == initialize_index or fetch, return ds
             return ds
         else:
             # else, subset datasets to be downloaded base don --uuid and --uuid-exclude
@@ -238,31 +419,467 @@ class Archivist:
             if len(ds) == 0:
                 sys.exit("No valid UUIDs specified. Exiting.")
             # shuffle order of datasets, if specified
-            if self.options["random_order"]:
+            if self.options["order"] == "random":
                 ds = {k: ds[k] for k in random.sample([*ds.keys()], len(ds))}
             # return dataset list
             return ds
     
+    def compile_ds_code(self):
+        """Compile the url_fun_python and proc/webdriver code of the datasets to be downloaded.
+
+        Code is compiled once per run and run from the compiled code objects (see utils.compiled).
+        Datasets with syntax errors are reported here and fail when they are downloaded.
+        """
+        for uuid, d in self.ds.items():
+            # url_fun_python from datasets.json
+            if "url_fun_python" in d:
+                try:
+                    compile_cached(d["url_fun_python"], "<url_fun_python: " + uuid + ">")
+                except SyntaxError as e:
+                    print(background(uuid + ": Syntax error in url_fun_python: " + str(e), Colors.red))
+            # special processing code for webdriver
+            proc_webdriver_path = os.path.join(self.options["project_dir"], "proc", "webdriver", uuid + ".py")
+            if os.path.exists(proc_webdriver_path):
+                with open(proc_webdriver_path) as proc_webdriver_file:
+                    source = proc_webdriver_file.read()
+                try:
+                    self.proc_webdriver[uuid] = compile_cached(source, proc_webdriver_path)
+                except SyntaxError as e:
+                    # keep error to raise when the dataset is downloaded
+                    self.proc_webdriver[uuid] = e
+                    print(background(uuid + ": Syntax error in special processing code for webdriver: " + str(e), Colors.red))
+
     def download_index(self):
-        print("Beginning download of index...")
-        d_path = os.path.join(self.options["project_dir"], "index.db")
+        """Load the index, reusing the local cache if it matches the snapshot on S3.
+
+        The cache directory is set by cache_dir in the [index] section of config.toml (defaults to
+        .index_cache in the project directory). A run holds a lock on the cache until it exits; if
+        another run holds the lock, a private copy of the index is downloaded to a directory for this run.
+        """
         d_key = os.path.join(self.s3["bucket_root"], "index.db")
-        self.s3["bucket"].download_file(Filename=d_path, Key=d_key)
-        self.index = sqlite_utils.Database(d_path)
-        print("Successfully downloaded index.")
+        self.index_cached = self.lock_index_cache()
+        if self.index_cached:
+            # the lock is held from the check below until the index is uploaded
+            d_path = os.path.join(self.index_cache_dir(), "index.db")
+            meta = self.read_index_cache_meta()
+            etag = self.s3["bucket"].Object(d_key).e_tag
+            if os.path.exists(d_path) and meta.get("etag") == etag and not meta.get("dirty", True):
+                print("Using cached index (ETag: " + etag + ").")
+            else:
+                print("Beginning download of index...")
+                # mark cache as dirty until the new copy is in place
+                self.write_index_cache_meta({"etag": etag, "dirty": True})
+                self.s3["bucket"].download_file(Filename=d_path + ".download", Key=d_key)
+                os.replace(d_path + ".download", d_path)
+                self.write_index_cache_meta({"etag": etag, "dirty": False})
+                print("Successfully downloaded index.")
+        else:
+            print("Beginning download of index...")
+            # private copy for this run in its own directory, so concurrent runs do not overwrite each other's copy
+            d_path = os.path.join(tempfile.mkdtemp(prefix="index_" + self.run_id + "_", dir=self.options["project_dir"]), "index.db")
+            self.s3["bucket"].download_file(Filename=d_path, Key=d_key)
+            print("Successfully downloaded index.")
+        self.index_path = d_path
+        import sqlite_utils # imported here to keep startup fast for runs that do not use the index
+        # allow connection to be shared by download workers (access is serialized by self.index_lock)
+        self.index = sqlite_utils.Database(sqlite3.connect(d_path, check_same_thread=False))
+        # mark cache as dirty while it is being modified
+        self.set_index_cache_dirty(True)
+        self.prepare_index()
+        # apply changesets uploaded since the snapshot was compacted
+        self.apply_index_changesets()
+        self.set_index_cache_dirty(False)
+        # prepare index for this run
+        if self.options["mode"] == "prod":
+            # load known files for the datasets in this run
+            self.load_known_files()
+            # recover index entries from an interrupted run
+            self.pending_index = []
+            self.recover_index_journal()
+
+    def close_index(self):
+        # close the index without uploading it (e.g., after fetch), deleting the private copy of this run, if any
+        self.index.conn.close()
+        if self.index_cached:
+            self.unlock_index_cache()
+        else:
+            shutil.rmtree(os.path.dirname(self.index_path))
+
+    def index_cache_dir(self):
+        cache_dir = self.config.get("index", {}).get("cache_dir", ".index_cache")
+        return os.path.join(self.options["project_dir"], cache_dir)
+
+    def lock_index_cache(self):
+        # lock the index cache for the rest of the run, returning False if it is in use by another run
+        os.makedirs(self.index_cache_dir(), exist_ok=True)
+        self.index_cache_lock = open(os.path.join(self.index_cache_dir(), "index.lock"), "w")
+        try:
+            fcntl.flock(self.index_cache_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            print("Index cache is in use by another run. Downloading a private copy of the index...")
+            self.index_cache_lock.close()
+            self.index_cache_lock = None
+            return False
+
+    def unlock_index_cache(self):
+        if getattr(self, "index_cache_lock", None) is not None:
+            fcntl.flock(self.index_cache_lock, fcntl.LOCK_UN)
+            self.index_cache_lock.close()
+            self.index_cache_lock = None
+
+    def read_index_cache_meta(self):
+        meta_path = os.path.join(self.index_cache_dir(), "index.json")
+        if not os.path.exists(meta_path):
+            return {}
+        try:
+            with open(meta_path, "r") as meta_file:
+                return json.load(meta_file)
+        except ValueError:
+            return {}
+
+    def write_index_cache_meta(self, meta):
+        # write metadata atomically
+        meta_path = os.path.join(self.index_cache_dir(), "index.json")
+        with open(meta_path + ".tmp", "w") as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def set_index_cache_dirty(self, dirty):
+        # a dirty cache may contain rows that are not on S3 and is downloaded again by the next run
+        if self.index_cached:
+            meta = self.read_index_cache_meta()
+            meta["dirty"] = dirty
+            self.write_index_cache_meta(meta)
+
+    def prepare_index(self):
+        # create tables and indexes added after the index was initialized
+        if "http_cache" not in self.index.table_names():
+            self.index["http_cache"].create({"uuid": str, "etag": str, "last_modified": str}, pk="uuid")
+        if "index_changesets" not in self.index.table_names():
+            self.index["index_changesets"].create({"name": str}, pk="name")
+        if "run_stats" not in self.index.table_names():
+            self.index["run_stats"].create({"run": str, "uuid": str, "host": str, "dl_fun": str, "duration": float, "attempts": int, "success": int})
+            self.index["run_stats"].create_index(["uuid"], index_name="idx_run_stats_uuid", if_not_exists=True)
+        columns = self.index["archive"].columns_dict
+        for col, col_type in STORAGE_COLUMNS.items():
+            if col not in columns:
+                self.index["archive"].add_column(col, col_type)
+        self.create_archive_indexes(self.index)
+        # stored copies of files added during this run (see find_stored_copy())
+        self.stored_files = {}
+
+    def index_changesets_prefix(self):
+        return os.path.join(self.s3["bucket_root"], "index_changes") + "/"
+
+    def write_index_rows(self, entries):
+        # write rows to the index in a single transaction (rows of http_cache replace existing rows)
+        archive_rows = [e["row"] for e in entries if e["table"] == "archive"]
+        http_cache_rows = [e["row"] for e in entries if e["table"] == "http_cache"]
+        run_stats_rows = [e["row"] for e in entries if e["table"] == "run_stats"]
+        with self.index.conn:
+            if len(archive_rows) > 0:
+                self.index["archive"].insert_all(archive_rows, batch_size=10000)
+            if len(http_cache_rows) > 0:
+                self.index["http_cache"].upsert_all(http_cache_rows, pk="uuid")
+            if len(run_stats_rows) > 0:
+                self.index["run_stats"].insert_all(run_stats_rows, batch_size=10000)
+        return len(archive_rows)
+
+    def apply_index_changesets(self):
+        """Apply changesets that are not yet part of the index.
+
+        Each run uploads the rows it added to the index as a changeset. Changesets are applied in
+        order of their names (which begin with the time of the run) and the names of applied
+        changesets are recorded in the index_changesets table, so applying them is idempotent.
+        """
+        prefix = self.index_changesets_prefix()
+        applied = set(row[0] for row in self.index.execute("SELECT name FROM index_changesets").fetchall())
+        keys = pending_changesets([obj.key for obj in self.s3["bucket"].objects.filter(Prefix=prefix)], applied)
+        if len(keys) == 0:
+            return []
+        print("Applying " + str(len(keys)) + " index changesets...")
+        tmpdir = tempfile.TemporaryDirectory()
+        for k in keys:
+            c_path = os.path.join(tmpdir.name, os.path.basename(k))
+            self.s3["bucket"].download_file(Filename=c_path, Key=k)
+            with gzip.open(c_path, "rt") as changeset:
+                entries = [json.loads(line) for line in changeset if line.strip()]
+            self.write_index_rows(entries)
+            self.index["index_changesets"].insert({"name": os.path.basename(k)})
+            os.remove(c_path)
+        print("Successfully applied index changesets.")
+        return keys
+
+    def create_archive_indexes(self, db):
+        # indexes for duplicate checks and for finding the latest file of a dataset
+        db["archive"].create_index(["uuid", "file_md5", "file_size"], index_name="idx_archive_uuid_md5_size", if_not_exists=True)
+        db["archive"].create_index(["uuid", "file_timestamp"], index_name="idx_archive_uuid_timestamp", if_not_exists=True)
+        # indexes for finding stored copies of a file across datasets and for looking up files by name
+        db["archive"].create_index(["file_md5", "file_size"], index_name="idx_archive_md5_size", if_not_exists=True)
+        db["archive"].create_index(["file_name"], index_name="idx_archive_file_name", if_not_exists=True)
+
+    def load_known_files(self):
+        """Load the (uuid, file_md5, file_size) of every unique file of the datasets in this run.
+
+        Only the first copy of a file is marked as a non-duplicate, so this is much smaller than the archive table.
+        """
+        self.known_files = set()
+        uuids = list(self.ds.keys())
+        # query in chunks to stay below SQLite's limit on the number of parameters
+        for i in range(0, len(uuids), 500):
+            chunk = uuids[i:i + 500]
+            rows = self.index.execute(
+                "SELECT uuid, file_md5, file_size FROM archive WHERE file_duplicate = 0 AND uuid IN (" + ", ".join("?" * len(chunk)) + ")",
+                chunk).fetchall()
+            self.known_files.update((row[0], row[1], int(row[2])) for row in rows)
+
+    def is_known_file(self, uuid, f_md5, f_size):
+        # check if a file has already been archived for a dataset
+        with self.index_lock:
+            return (uuid, f_md5, f_size) in self.known_files
+
+    def get_http_validators(self, uuid):
+        # get ETag and Last-Modified headers from the last download of a dataset
+        with self.index_lock:
+            row = self.index.execute("SELECT etag, last_modified FROM http_cache WHERE uuid = ?", (uuid,)).fetchone()
+        if row is None:
+            return None
+        return {"etag": row[0], "last_modified": row[1]}
+
+    def set_http_validators(self, uuid, validators):
+        # record ETag and Last-Modified headers from the last download of a dataset
+        self.queue_index("http_cache", {"uuid": uuid, "etag": validators["etag"], "last_modified": validators["last_modified"]})
+
+    def find_stored_copy(self, f_md5, f_size):
+        """Find a stored copy of a file already stored for any dataset.
+
+        Content-addressed copies are preferred. Files stored at their original path (e.g., before
+        content-addressed storage was enabled) are also matched, with their path as file_key.
+        Deltas are not matched, as they can only be reconstructed within their own dataset.
+
+        Returns:
+        dict: The storage columns (see STORAGE_COLUMNS) of the stored copy, or None if there is no stored copy.
+        """
+        with self.index_lock:
+            if (f_md5, f_size) in self.stored_files:
+                return dict(self.stored_files[(f_md5, f_size)])
+            cols = list(STORAGE_COLUMNS)
+            row = self.index.execute(
+                "SELECT " + ", ".join(cols) + " FROM archive WHERE file_md5 = ? AND file_size = ? AND file_key IS NOT NULL AND file_base IS NULL LIMIT 1",
+                (f_md5, f_size)).fetchone()
+            if row is not None:
+                return dict(zip(cols, row))
+            # files stored at their original path
+            legacy = self.index.execute(
+                "SELECT uuid, file_name, " + ", ".join(cols) + " FROM archive WHERE file_md5 = ? AND file_size = ? AND file_key IS NULL AND file_base IS NULL AND file_duplicate = 0",
+                (f_md5, f_size)).fetchall()
+        for row in legacy:
+            # the path is only known for datasets still in datasets.json (self.ds may be limited by --uuid)
+            d = self.catalog["ds"].get(row[0])
+            if d is not None:
+                stored = dict(zip(cols, row[2:]))
+                stored["file_key"] = os.path.join(d["dir_parent"], d["dir_file"], row[1])
+                return stored
+        return None
+
+    def record_run_stats(self, uuid, url, dl_fun, duration, attempts, success):
+        # record duration and outcome of a dataset download, used to schedule later runs (see utils.scheduler)
+        self.queue_index("run_stats", {
+            "run": self.t,
+            "uuid": uuid,
+            "host": urlparse(url).hostname,
+            "dl_fun": dl_fun,
+            "duration": round(duration, 3),
+            "attempts": attempts,
+            "success": 1 if success else 0
+        })
+
+    def load_run_history(self, uuids):
+        """Load the recent download history of datasets from the run_stats table.
+
+        The number of runs considered is set by history_runs in the [scheduling] section of config.toml.
+
+        Returns:
+        dict: For each UUID with history, the median duration in seconds, the failure rate,
+        the host of the last download and the number of runs.
+        """
+        history_runs = self.config.get("scheduling", {}).get("history_runs", 20)
+        rows = {}
+        # query in chunks to stay below SQLite's limit on the number of parameters
+        with self.index_lock:
+            for i in range(0, len(uuids), 500):
+                chunk = uuids[i:i + 500]
+                for uuid, host, duration, success in self.index.execute(
+                    "SELECT uuid, host, duration, success FROM run_stats WHERE uuid IN (" + ", ".join("?" * len(chunk)) + ") ORDER BY rowid DESC",
+                    chunk).fetchall():
+                    runs = rows.setdefault(uuid, [])
+                    if len(runs) < history_runs:
+                        runs.append((host, duration, success))
+        history = {}
+        for uuid, runs in rows.items():
+            durations = sorted(r[1] for r in runs)
+            history[uuid] = {
+                "duration": durations[len(durations) // 2],
+                "failure_rate": sum(1 for r in runs if r[2] == 0) / len(runs),
+                "host": runs[0][0],
+                "runs": len(runs)
+            }
+        return history
+
+    def load_change_history(self, uuids):
+        """Load the recent snapshots of datasets from the archive table.
+
+        The period considered is set by change_window_days in the [scheduling] section of config.toml.
+
+        Returns:
+        dict: For each UUID with snapshots, the timestamps (seconds since the epoch) and MD5 hashes of
+        its snapshots, in chronological order.
+        """
+        window_days = self.config.get("scheduling", {}).get("change_window_days", 90)
+        since = time.time() - window_days * 86400
+        history = {}
+        # query in chunks to stay below SQLite's limit on the number of parameters
+        with self.index_lock:
+            for i in range(0, len(uuids), 500):
+                chunk = uuids[i:i + 500]
+                for uuid, f_timestamp, f_md5 in self.index.execute(
+                    "SELECT uuid, file_timestamp, file_md5 FROM archive WHERE file_timestamp >= ? AND uuid IN (" + ", ".join("?" * len(chunk)) + ") ORDER BY file_timestamp",
+                    [since] + chunk).fetchall():
+                    history.setdefault(uuid, []).append((float(f_timestamp), f_md5))
+        return history
+
+    def index_journal_path(self, run_id = None):
+        # each run writes its own journal, e.g., index_journal.12345.20210131120000.jsonl
+        if run_id is None:
+            run_id = self.run_id
+        return os.path.join(self.options["project_dir"], "index_journal." + run_id + ".jsonl")
+
+    def journal_run_alive(self, journal_path):
+        # check if the run that wrote a journal is still running, using the process ID in its name
+        try:
+            pid = int(os.path.basename(journal_path).split(".")[1])
+        except (IndexError, ValueError):
+            # journal written before journals were named by run
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def queue_index(self, table, row):
+        """Queue a row to be written to the index at the end of the run.
+
+        Rows are also appended to a journal in the project directory, so they can be recovered
+        by the next run if this run is interrupted before the index is uploaded.
+        """
+        with self.index_lock:
+            self.pending_index.append({"table": table, "row": row})
+            if table == "archive":
+                self.known_files.add((row["uuid"], row["file_md5"], row["file_size"]))
+                if row.get("file_key") is not None and row.get("file_base") is None:
+                    self.stored_files[(row["file_md5"], row["file_size"])] = {col: row.get(col) for col in STORAGE_COLUMNS}
+            with open(self.index_journal_path(), "a") as journal_file:
+                journal_file.write(json.dumps({"table": table, "row": row}) + "\n")
+
+    def recover_index_journal(self):
+        """Queue rows from the journals of interrupted runs that are missing from the index.
+
+        Journals of runs that are still running are left alone. Recovered rows are moved to the
+        journal of this run, so they are not lost if this run is also interrupted. Recovery holds
+        a lock in the index cache directory, so two runs cannot recover the same journal.
+        """
+        os.makedirs(self.index_cache_dir(), exist_ok=True)
+        with open(os.path.join(self.index_cache_dir(), "journal.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                for journal_path in sorted(glob.glob(os.path.join(self.options["project_dir"], "index_journal*.jsonl"))):
+                    if journal_path == self.index_journal_path() or self.journal_run_alive(journal_path):
+                        continue
+                    self.recover_journal_file(journal_path)
+                    os.remove(journal_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def recover_journal_file(self, journal_path):
+        n = 0
+        with open(journal_path, "r") as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # ignore partially written line
+                    continue
+                row = entry["row"]
+                if entry["table"] == "archive":
+                    query = self.index.execute("SELECT COUNT(*) FROM archive WHERE uuid = ? AND file_name = ?", (row["uuid"], row["file_name"]))
+                    if query.fetchone()[0] > 0:
+                        continue
+                    n += 1
+                elif entry["table"] == "run_stats":
+                    query = self.index.execute("SELECT COUNT(*) FROM run_stats WHERE run = ? AND uuid = ?", (row["run"], row["uuid"]))
+                    if query.fetchone()[0] > 0:
+                        continue
+                # copy row to the journal of this run
+                self.queue_index(entry["table"], row)
+        if n > 0:
+            print("Recovered " + str(n) + " index entries from an interrupted run (" + os.path.basename(journal_path) + ").")
+
+    def flush_index(self):
+        # write queued rows to the index in a single transaction
+        with self.index_lock:
+            if len(self.pending_index) == 0:
+                return
+            n = self.write_index_rows(self.pending_index)
+            print("Wrote " + str(n) + " entries to index.")
+            self.pending_index = []
+
+    def remove_index_journal(self):
+        if os.path.exists(self.index_journal_path()):
+            os.remove(self.index_journal_path())
     
     def upload_index(self):
-        print("Beginning upload of index...")
-        d_path = os.path.join(self.options["project_dir"], "index.db")
-        d_key = os.path.join(self.s3["bucket_root"], "index.db")
+        """Upload the rows added to the index during this run as a changeset.
+
+        The full index is only uploaded by compact_index(), which folds changesets into the snapshot.
+        """
+        # write entries from this run to a changeset
+        with self.index_lock:
+            entries = list(self.pending_index)
+        tmpdir = tempfile.TemporaryDirectory()
+        c_name = changeset_name()
+        c_path = os.path.join(tmpdir.name, c_name)
+        with gzip.open(c_path, "wt") as changeset:
+            for e in entries:
+                changeset.write(json.dumps(e) + "\n")
+        # write entries from this run to index (the cache is dirty until the changeset is uploaded)
+        self.set_index_cache_dirty(True)
+        self.flush_index()
+        self.index["index_changesets"].insert({"name": c_name})
+        print("Beginning upload of index changeset (" + str(len(entries)) + " rows)...")
+        d_path = self.index_path
+        d_key = self.index_changesets_prefix() + c_name
         def upload_fun():
-            self.s3["bucket"].upload_file(Filename=d_path, Key=d_key)
-            print("Successfully uploaded index.")
-            # delete local copy of index after successful upload
-            os.remove(d_path)
+            if len(entries) > 0:
+                self.s3["bucket"].upload_file(Filename=c_path, Key=d_key)
+            print("Successfully uploaded index changeset.")
+            # entries from this run no longer need to be recovered
+            self.remove_index_journal()
+            if self.index_cached:
+                # cached index now matches snapshot and changesets on S3
+                self.set_index_cache_dirty(False)
+                self.unlock_index_cache()
+            else:
+                # delete local copy of index after successful upload
+                shutil.rmtree(os.path.dirname(d_path))
         ## try to upload index up to 3 times
         if self.debug_options["no_upload"]:
             print("DEBUG: Skipping index upload. Local copy of index will not be deleted.")
+            # files were not uploaded either, so entries should not be recovered
+            self.remove_index_journal()
         else:
             try:
                 upload_fun()
@@ -278,10 +895,43 @@ class Archivist:
                     time.sleep(300)
                     upload_fun() # don't catch exception
 
+    def compact_index(self):
+        """Fold all changesets into a new snapshot of the index and upload it.
+
+        Changesets are deleted after the new snapshot is uploaded. Readers that see both the new
+        snapshot and a folded changeset skip the changeset, as its name is recorded in the snapshot.
+        """
+        self.download_index()
+        d_path = self.index_path
+        d_key = os.path.join(self.s3["bucket_root"], "index.db")
+        # get folded changesets
+        prefix = self.index_changesets_prefix()
+        applied = set(row[0] for row in self.index.execute("SELECT name FROM index_changesets").fetchall())
+        folded = folded_changesets([obj.key for obj in self.s3["bucket"].objects.filter(Prefix=prefix)], applied)
+        self.index.conn.close()
+        if self.debug_options["no_upload"]:
+            print("DEBUG: Skipping upload of compacted index. Local copy of index will not be deleted.")
+            return
+        print("Uploading compacted index...")
+        self.s3["bucket"].upload_file(Filename=d_path, Key=d_key)
+        print("Successfully uploaded compacted index.")
+        # delete folded changesets
+        for i in range(0, len(folded), 1000):
+            self.s3["bucket"].delete_objects(Delete={"Objects": [{"Key": k} for k in folded[i:i + 1000]]})
+        print("Deleted " + str(len(folded)) + " folded index changesets.")
+        if self.index_cached:
+            # cached index now matches the new snapshot
+            self.write_index_cache_meta({"etag": self.s3["bucket"].Object(d_key).e_tag, "dirty": False})
+            self.unlock_index_cache()
+        else:
+            shutil.rmtree(os.path.dirname(d_path))
+
     def print_success_failure(self):
         total_files = str(self.log["success"] + self.log["failure"])
         print(background('Successful downloads: ' + str(self.log["success"]) + '/' + total_files, Colors.blue))
         print(background('Failed downloads: ' + str(self.log["failure"]) + '/' + total_files, Colors.red))
+        if self.log["skipped"] > 0:
+            print(background('Skipped datasets: ' + str(self.log["skipped"]), Colors.orange))
     
     def print_failed_uuids(self):
         for i in self.log["failure_uuid"]:
@@ -299,8 +949,12 @@ class Archivist:
             code += " --upload-log"
         if self.options["allow_inactive"]:
             code += " --allow-inactive"
-        if self.options["random_order"]:
-            code += " --random-order"
+        if self.options["order"] != "listed":
+            code += " --order " + self.options["order"]
+        if self.options["workers"] > 1:
+            code += " --workers " + str(self.options["workers"])
+        if self.options["prefetch"]:
+            code += " --prefetch"
         if len(self.debug) > 0:
             code += " --debug " + " ".join(self.debug)
         # add failed UUIDs
@@ -324,6 +978,11 @@ class Archivist:
         total_files = str(success + failure)
         # assemble log text
         log = 'Successful downloads: ' + str(success) + '/' + total_files + '\n' + 'Failed downloads: ' + str(failure) + '/' + total_files + '\n' + log + '\n'
+        if self.log["skipped"] > 0:
+            log = 'Skipped datasets (unlikely to have changed): ' + str(self.log["skipped"]) + '\n' + log
+        # add connection reuse stats
+        http_stats = self.http_stats()
+        log = 'Reused HTTP connections: ' + str(http_stats["reused"]) + '/' + str(http_stats["requests"]) + ' requests\n' + log
         if failure > 0:
             log = log + '\n' + self.generate_rerun_code()
         log = self.t + '\n\n' + log
@@ -347,40 +1006,75 @@ class Archivist:
             print(color("Recent log upload successful!", Colors.green))
         except:
             print(background("Recent log upload failed!", Colors.red))
-        print("Appending recent log to full log...")
+        print("Uploading log segment...")
         try:
-            # read in full log
-            tmpdir = tempfile.TemporaryDirectory()
-            d_path = os.path.join(tmpdir.name, "log.txt")
-            d_key = os.path.join(self.s3["bucket_root"], "log.txt")
-            self.s3["bucket"].download_file(Filename=d_path, Key=d_key)
-            with open(d_path, "r") as full_log:
-                full_log = full_log.read()
-            # append recent log to full log
-            log = full_log + '\n\n' + log
-            # write log temporarily and upload
-            f_path = os.path.join(tmpdir.name, "log.txt")
-            f_key = os.path.join(self.s3["bucket_root"], "log.txt")
-            with open(f_path, "w") as local_file:
-                local_file.write(log)
+            # upload log of this run as its own segment, partitioned by date (see stitch_log())
+            f_key = self.log_segment_key()
             if self.debug_options["no_upload"]:
                 print("DEBUG: Skipping log upload.")
             else:
                 self.s3["bucket"].upload_file(Filename=f_path, Key=f_key)
             # report success
-            print(color("Full log upload successful!", Colors.green))
+            print(color("Log segment upload successful!", Colors.green))
         except:
-            print(background("Full log upload failed!", Colors.red))
+            print(background("Log segment upload failed!", Colors.red))
+
+    def log_segments_prefix(self):
+        return os.path.join(self.s3["bucket_root"], "logs") + "/"
+
+    def log_segment_key(self):
+        # e.g., logs/2021/01/31/2021-01-31_12-00-00.txt, based on the start time of the run
+        t = datetime.strptime(self.t[:19], "%Y-%m-%d %H:%M:%S")
+        return self.log_segments_prefix() + t.strftime("%Y/%m/%d/%Y-%m-%d_%H-%M-%S") + ".txt"
+
+    def stitch_log(self, out_path = None, since = None):
+        """Combine the full log (log.txt, from before logs were segmented) and all log segments into a single file.
+
+        Parameters:
+            out_path (str): Path to output file. By default, a file named 'log.txt' is created in the project directory.
+            since (str): Optional. Only include segments of runs on or after this date (YYYY-MM-DD).
+        """
+        if out_path is None:
+            out_path = os.path.join(self.options["project_dir"], "log.txt")
+        # list segments in order
+        prefix = self.log_segments_prefix()
+        keys = sorted(obj.key for obj in self.s3["bucket"].objects.filter(Prefix=prefix))
+        if since is not None:
+            keys = [k for k in keys if os.path.basename(k)[:10] >= since]
+        tmpdir = tempfile.TemporaryDirectory()
+        d_path = os.path.join(tmpdir.name, "log.txt")
+        logs = []
+        # include full log from before logs were segmented
+        if since is None:
+            try:
+                self.s3["bucket"].download_file(Filename=d_path, Key=os.path.join(self.s3["bucket_root"], "log.txt"))
+                with open(d_path, "r") as full_log:
+                    logs.append(full_log.read())
+            except Exception:
+                print("No full log found. Only log segments will be included.")
+        # download segments
+        for k in keys:
+            self.s3["bucket"].download_file(Filename=d_path, Key=k)
+            with open(d_path, "r") as segment:
+                logs.append(segment.read())
+        with open(out_path, "w") as local_file:
+            local_file.write('\n\n'.join(logs))
+        print("Stitched " + str(len(keys)) + " log segments into: " + out_path)
     
-    def initialize_index(self, archive_dir, out_path):
+    def initialize_index(self, archive_dir, out_path, incremental = False, from_s3 = False):
 
         """Initialize SQLite database index from local mirror of S3 bucket (e.g., created using `aws s3 sync`).
 
         Parameters:
             archive_path (str): Path to local mirror of S3 bucket.
             out_path (str): Path to output SQLite database index. By default, a file named 'index.db' is create in the 'dir_archive' directory.
+            incremental (bool): If True, update an existing index. Files already in the index with the same name, size and modification time are not hashed again.
+            from_s3 (bool): If True, build the index from a listing of the S3 bucket instead of a local mirror (see list_s3_files()).
         """
 
+        # verify the index can be rebuilt from the files in the bucket
+        self.check_storage_layouts(archive_dir, from_s3)
+
         # get output path
         if out_path is None:
             out_path = os.path.join(archive_dir, "index.db")
@@ -388,78 +1082,265 @@ class Archivist:
         # print output path
         print("Index will be written to: " + out_path)
 
-        # create database
+        # create database and main table
+        import sqlite_utils # imported here to keep startup fast for runs that do not use the index
         db = sqlite_utils.Database(out_path)
+        if incremental and "archive" in db.table_names():
+            print("Updating existing index...")
+        else:
+            incremental = False
+            db["archive"].create({"uuid": str, "file_name": str, "file_timestamp": int, "file_date": str, "file_duplicate": int, "file_md5": str, "file_size": int})
+        # create sidecar table of file sizes and modification times in the local mirror
+        if "file_stat" not in db.table_names():
+            db["file_stat"].create({"uuid": str, "file_name": str, "file_size": int, "file_mtime": float}, pk=("uuid", "file_name"))
+        # get files already in the index (file_mtime is None for files not yet in the sidecar table)
+        existing = {}
+        if incremental:
+            for row in db.execute("SELECT uuid, file_name, file_size FROM archive"):
+                existing[(row[0], row[1])] = (row[2], None)
+            for row in db.execute("SELECT uuid, file_name, file_size, file_mtime FROM file_stat"):
+                if (row[0], row[1]) in existing:
+                    existing[(row[0], row[1])] = (row[2], row[3])
 
         # get dataset list
         ds = self.ds
-        
-        # create list to hold results
-        dfs = []
-
-        # function to index a single UUID
-        def index_uuid(uuid):
-            # get path
-            path_uuid = os.path.join(ds[uuid]['dir_parent'], ds[uuid]['dir_file'])
-            path_dir = os.path.join(archive_dir, path_uuid)
-            # skip if path does not exist
-            if not os.path.exists(path_dir):
-                print("Skipping " + uuid + " because path does not exist: " + path_dir)
-                return None
-            # report UUID
-            print(uuid + ": " + path_dir)
-            # get list of files, excluding subdirectories, and sort
-            files = [f for f in os.listdir(path_dir) if os.path.isfile(os.path.join(path_dir, f))]
-            files.sort()
-            # create lists for file attributes
-            file_name = []
-            file_timestamp = []
-            file_date = []
-            file_size = []
-            file_md5 = []
-            # loop through files
-            for f in files:
-                # get file path
-                f_path = os.path.join(path_dir, f)
-                # add file name
-                file_name.append(f)
-                # extract timestamp from file name
-                file_timestamp.append(re.search('(?<=_)(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}).*$', f).group(1))
-                # extract date from file name
-                file_date.append(re.search('(?<=_)(\d{4}-\d{2}-\d{2}).*$', f).group(1))
-                # get file size
-                file_size.append(os.path.getsize(f_path))
-                # calculate file MD5 hash
-                with open(f_path, 'rb') as f_data:
-                    data = f_data.read()
-                    f_md5 = hashlib.md5(data).hexdigest()
-                file_md5.append(f_md5)
-            # create dataframe
-            df = pd.DataFrame({'uuid': uuid, 'file_name': file_name, 'file_timestamp': file_timestamp, 'file_date': file_date, 'file_size': file_size, 'file_md5': file_md5})
-            # return dataframe
-            return df
-        # loop through UUIDs
-        for uuid in ds.keys():
-            df = index_uuid(uuid)
-            dfs.append(df)
-        # concatenate dataframes
-        df = pd.concat(dfs, ignore_index=True)
-        # convert timestamp string to epoch
         tz = self.config["project"]["tz"]
-        df['file_timestamp'] = pd.to_datetime(df['file_timestamp'], format='%Y-%m-%d_%H-%M').dt.tz_localize(tz=tz).astype(int) / 10**9
-        # sort by UUID and timestamp
-        df = df.sort_values(by=['uuid', 'file_timestamp']).reset_index(drop=True)
-        # create table of unique UUIDs and file hashes
-        df_unique = df.drop_duplicates(subset=['uuid', 'file_md5', 'file_size'], keep='first')[['uuid', 'file_name', 'file_md5', 'file_size']].reset_index(drop=True)
-        # mark unique files
-        df_unique['file_duplicate'] = 0
-        # left join to origin dataframe
-        df = df.merge(df_unique[['uuid', 'file_name', 'file_duplicate']], how='left', on=['uuid', 'file_name'])
-        # fill NaNs with 1
-        df['file_duplicate'] = df['file_duplicate'].fillna(1)
-        # create main table and insert data
-        db["archive"].create({"uuid": str, "file_name": str, "file_timestamp": int, "file_date": str, "file_duplicate": int, "file_md5": str, "file_size": int})
-        db["archive"].insert_all(df.to_dict("records"), batch_size=10000)
+
+        # list files to hash
+        jobs = []
+        total_bytes = 0
+        file_stats = []
+        changed = []
+        # files are listed as (file name, size, modification time, source), where source is a local path or an S3 object
+        if from_s3:
+            listing = self.list_s3_files(ds)
+        else:
+            listing = {}
+            for uuid in ds.keys():
+                # get path
+                path_uuid = os.path.join(ds[uuid]['dir_parent'], ds[uuid]['dir_file'])
+                path_dir = os.path.join(archive_dir, path_uuid)
+                # skip if path does not exist
+                if not os.path.exists(path_dir):
+                    print("Skipping " + uuid + " because path does not exist: " + path_dir)
+                    continue
+                # get list of files, excluding subdirectories, and sort
+                files = [f for f in os.listdir(path_dir) if os.path.isfile(os.path.join(path_dir, f))]
+                files.sort()
+                listing[uuid] = []
+                for f in files:
+                    f_path = os.path.join(path_dir, f)
+                    f_stat = os.stat(f_path)
+                    listing[uuid].append((f, f_stat.st_size, f_stat.st_mtime, f_path))
+        for uuid in listing.keys():
+            for f, f_size_new, f_mtime_new, f_source in listing[uuid]:
+                file_stats.append({"uuid": uuid, "file_name": f, "file_size": f_size_new, "file_mtime": f_mtime_new})
+                # skip unchanged files
+                if (uuid, f) in existing:
+                    f_size, f_mtime = existing[(uuid, f)]
+                    if f_size == f_size_new and (f_mtime is None or f_mtime == f_mtime_new):
+                        continue
+                    changed.append((uuid, f))
+                jobs.append((uuid, f, f_source))
+                total_bytes += f_size_new
+        # remove rows of changed files
+        if len(changed) > 0:
+            print("Re-indexing " + str(len(changed)) + " changed files...")
+            with db.conn:
+                db.conn.executemany("DELETE FROM archive WHERE uuid = ? AND file_name = ?", changed)
+        print("Hashing " + str(len(jobs)) + " files (" + format_size(total_bytes) + ") using " + str(self.options["workers"]) + " workers...")
+
+        # hash files in worker processes, writing the rows of each UUID as soon as all of its files are hashed
+        rows = []
+        uuid_files = []
+        current_uuid = None
+        n_files = 0
+        n_bytes = 0
+        worker_stats = {}
+        t0 = time.monotonic()
+        t_progress = t0
+        def write_rows(rows, force = False):
+            # insert rows in batches
+            if len(rows) >= 10000 or (force and len(rows) > 0):
+                db["archive"].insert_all(rows, batch_size=10000)
+                return []
+            return rows
+        # files in the local mirror are hashed in worker processes, S3 objects without an MD5 ETag are downloaded and hashed in threads
+        if from_s3:
+            executor = ThreadPoolExecutor(max_workers=self.options["workers"])
+            hash_fun = self.hash_s3_object
+            # storage columns of compressed files and deltas, recorded by hash_s3_object()
+            self.s3_storage = {}
+        else:
+            executor = ProcessPoolExecutor(max_workers=self.options["workers"])
+            hash_fun = hash_file
+        with executor:
+            for uuid, f, f_size, f_md5, pid, t_hash in executor.map(hash_fun, jobs, chunksize=16):
+                # create rows for the previous UUID
+                if uuid != current_uuid:
+                    if current_uuid is not None:
+                        rows.extend(index_rows(current_uuid, uuid_files, tz))
+                        rows = write_rows(rows)
+                    current_uuid = uuid
+                    uuid_files = []
+                    print(uuid + ": " + os.path.join(ds[uuid]['dir_parent'], ds[uuid]['dir_file']))
+                uuid_files.append((f, f_size, f_md5))
+                # record progress and per-worker throughput
+                n_files += 1
+                n_bytes += f_size
+                if pid is not None:
+                    stats = worker_stats.setdefault(pid, [0, 0])
+                    stats[0] += f_size
+                    stats[1] += t_hash
+                if time.monotonic() - t_progress >= 10:
+                    t_progress = time.monotonic()
+                    print("Progress: " + str(n_files) + "/" + str(len(jobs)) + " files, " + format_size(n_bytes) + "/" + format_size(total_bytes) +
+                          " (" + format_size(n_bytes / max(t_progress - t0, 1e-9)) + "/s)")
+        # create rows for the last UUID
+        if current_uuid is not None:
+            rows.extend(index_rows(current_uuid, uuid_files, tz))
+        write_rows(rows, force=True)
+        # record how compressed files and deltas are stored
+        if from_s3 and len(self.s3_storage) > 0:
+            columns = db["archive"].columns_dict
+            for col, col_type in STORAGE_COLUMNS.items():
+                if col not in columns:
+                    db["archive"].add_column(col, col_type)
+            with db.conn:
+                db.conn.executemany(
+                    "UPDATE archive SET " + ", ".join(col + " = ?" for col in STORAGE_COLUMNS) + " WHERE uuid = ? AND file_name = ?",
+                    [[storage.get(col) for col in STORAGE_COLUMNS] + [uuid, f] for (uuid, f), storage in self.s3_storage.items()])
+            print("Recorded storage of " + str(len(self.s3_storage)) + " compressed files and deltas.")
+        # record sizes and modification times of indexed files
+        db["file_stat"].upsert_all(file_stats, pk=("uuid", "file_name"), batch_size=10000)
+        # recompute duplicates for UUIDs with new or changed files
+        if incremental:
+            self.recompute_duplicates(db, list(dict.fromkeys(job[0] for job in jobs)))
+        # report throughput
+        t_total = time.monotonic() - t0
+        print("Hashed " + str(n_files) + " files (" + format_size(n_bytes) + ") in " + str(round(t_total, 1)) + " seconds.")
+        for pid, stats in worker_stats.items():
+            print("Worker " + str(pid) + ": " + format_size(stats[0]) + " (" + format_size(stats[0] / max(stats[1], 1e-9)) + "/s)")
+        # create indexes
+        self.create_archive_indexes(db)
+
+    def check_storage_layouts(self, archive_dir, from_s3):
+        """Exit if the index cannot be rebuilt because of the storage options used (see the [storage] section of config.toml).
+
+        Files stored by content (blobs/) or in bundles (bundles/) are only linked to their datasets by the
+        index, so the index cannot be rebuilt from the bucket. A local mirror has no object metadata, so
+        compressed files and deltas cannot be hashed as their original content either.
+        """
+        storage = self.config.get("storage", {})
+        problems = []
+        if storage.get("content_addressed", False) or storage.get("bundle", False):
+            problems.append("content-addressed storage or bundles are enabled in config.toml")
+        for prefix in ["blobs", "bundles"]:
+            if from_s3:
+                found = len(self.s3["bucket"].meta.client.list_objects_v2(
+                    Bucket=self.s3["bucket_name"], Prefix=os.path.join(self.s3["bucket_root"], prefix) + "/", MaxKeys=1).get("Contents", [])) > 0
+            else:
+                found = os.path.exists(os.path.join(archive_dir, prefix))
+            if found:
+                problems.append("the bucket contains " + prefix + "/")
+        if not from_s3 and (storage.get("delta", False) or storage.get("compress", "none") not in [None, "none"]):
+            problems.append("delta storage or compression is enabled in config.toml (use --from-s3)")
+        if len(problems) > 0:
+            sys.exit("The index cannot be rebuilt, as " + " and ".join(problems) + ". Use an existing index instead (see compact_index).")
+
+    def list_s3_files(self, ds):
+        """List the files of each dataset in the S3 bucket.
+
+        Prefixes are listed in parallel. Sizes and modification times are taken from the listing.
+        The MD5 hash is taken from the ETag where it is a plain MD5 hash (i.e., the object was not
+        uploaded in multiple parts); other objects are downloaded and hashed by hash_s3_object().
+        Deltas (name.delta) are listed under the name of the original file. If delta storage or
+        compression is enabled in config.toml, or for deltas, the metadata of each object is checked
+        by hash_s3_object(), as the stored content may differ from the original file.
+
+        Returns:
+        dict: For each UUID, a list of (file name, size, modification time, (key, size, MD5 hash or None, check metadata)).
+        """
+        client = self.s3["bucket"].meta.client
+        storage = self.config.get("storage", {})
+        check_all = storage.get("delta", False) or storage.get("compress", "none") not in [None, "none"]
+        def list_uuid(uuid):
+            prefix = os.path.join(self.s3["bucket_root"], ds[uuid]['dir_parent'], ds[uuid]['dir_file']) + "/"
+            files = []
+            for page in client.get_paginator("list_objects_v2").paginate(Bucket=self.s3["bucket_name"], Prefix=prefix):
+                for obj in page.get("Contents", []):
+                    f = obj["Key"][len(prefix):]
+                    # exclude subdirectories
+                    if f == "" or "/" in f:
+                        continue
+                    etag = obj["ETag"].strip('"')
+                    f_md5 = etag if MD5_RE.fullmatch(etag) else None
+                    is_delta = f.endswith(".delta")
+                    if is_delta:
+                        f = f[:-len(".delta")]
+                    files.append((f, obj["Size"], obj["LastModified"].timestamp(), (obj["Key"], obj["Size"], f_md5, check_all or is_delta)))
+            files.sort()
+            return uuid, files
+        listing = {}
+        with ThreadPoolExecutor(max_workers=self.options["workers"]) as executor:
+            for uuid, files in executor.map(list_uuid, ds.keys()):
+                if len(files) == 0:
+                    print("Skipping " + uuid + " because no files were found")
+                    continue
+                listing[uuid] = files
+        print("Listed " + str(sum(len(files) for files in listing.values())) + " files in S3 bucket.")
+        return listing
+
+    def hash_s3_object(self, job):
+        """Get the MD5 hash and size of the original content of an S3 object (same output as hash_file()).
+
+        If the metadata of the object is checked, the MD5 hash and size recorded when the object was
+        uploaded compressed or as a delta are used; compressed objects without these are downloaded and
+        decompressed. Otherwise, the MD5 hash is taken from the ETag or the object is downloaded and hashed.
+        """
+        uuid, f, (key, f_size, f_md5, check) = job
+        client = self.s3["bucket"].meta.client
+        t0 = time.monotonic()
+        encoding = None
+        if check:
+            head = client.head_object(Bucket=self.s3["bucket_name"], Key=key)
+            meta = head.get("Metadata", {})
+            encoding = head.get("ContentEncoding")
+            if key.endswith(".delta") and not ("md5" in meta and "size" in meta and "base" in meta):
+                raise Exception("Delta has no original MD5 hash, size and base in its metadata, so the index cannot be rebuilt: " + key)
+            if encoding is not None or key.endswith(".delta"):
+                # record how the file is stored (see STORAGE_COLUMNS)
+                self.s3_storage[(uuid, f)] = {
+                    "file_key": key[len(os.path.join(self.s3["bucket_root"], "")):] if key.endswith(".delta") else None,
+                    "file_base": meta.get("base"),
+                    "file_chain": int(meta.get("chain", 0)),
+                    "file_encoding": encoding,
+                    "file_stored_size": head["ContentLength"]
+                }
+            if "md5" in meta and "size" in meta:
+                return uuid, f, int(meta["size"]), meta["md5"], None, 0
+        if encoding is None and f_md5 is not None:
+            return uuid, f, f_size, f_md5, None, 0
+        body = client.get_object(Bucket=self.s3["bucket_name"], Key=key)["Body"]
+        if encoding is not None:
+            data = open_decompressed(body, encoding)
+            f_md5, f_size = md5_chunks(iter(lambda: data.read(CHUNK_SIZE), b""))
+        else:
+            f_md5, f_size = md5_chunks(body.iter_chunks(chunk_size=CHUNK_SIZE))
+        return uuid, f, f_size, f_md5, threading.get_ident(), time.monotonic() - t0
+
+    def recompute_duplicates(self, db, uuids):
+        # mark duplicates among all files of each UUID
+        n = 0
+        for uuid in uuids:
+            rows = [{"rowid": r[0], "file_name": r[1], "file_timestamp": r[2], "file_md5": r[3], "file_size": r[4], "file_duplicate": r[5]}
+                    for r in db.execute("SELECT rowid, file_name, file_timestamp, file_md5, file_size, file_duplicate FROM archive WHERE uuid = ?", (uuid,))]
+            old = {r["rowid"]: r["file_duplicate"] for r in rows}
+            updates = [(r["file_duplicate"], r["rowid"]) for r in mark_duplicates(rows) if r["file_duplicate"] != old[r["rowid"]]]
+            with db.conn:
+                db.conn.executemany("UPDATE archive SET file_duplicate = ? WHERE rowid = ?", updates)
+            n += len(updates)
+        print("Updated duplicate flags of " + str(n) + " files in " + str(len(uuids)) + " datasets.")
 
 # create Archivist object
 Archivist = Archivist()
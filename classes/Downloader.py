@@ -3,27 +3,48 @@ import os
 from datetime import datetime
 import time
 import tempfile
+import shutil
+import threading
+import mimetypes
 from zipfile import ZipFile
-import hashlib
 from humanfriendly import parse_size, format_size
 from colorit import *
-import requests
-import urllib3
-import ssl
-import pandas as pd
 
 # import classes
 from archivist.classes.Archivist import Archivist as a
-from archivist.classes.Webdriver import Webdriver
+from archivist.classes.Webdriver import WebdriverPool as wp
+from archivist.classes.Uploader import Uploader as up
 
 # import functions
 from archivist.utils.common import get_datetime
+from archivist.utils.compiled import compile_cached
+from archivist.utils.hashing import CHUNK_SIZE, md5_file, write_chunks
+from archivist.utils.indexing import timestamp_to_epoch
+from archivist.utils.retrieve import blob_key, read_file, resolve_file
+from archivist.utils.storage import compress_file, make_delta
+
+# define functions
+def resolve_url(uuid):
+    """Run the url_fun_python code of a dataset, which returns the URL as url_current in its namespace.
+
+    The code runs in a single namespace, so functions defined in it can see its imports and variables.
+    """
+    namespace = {}
+    exec(compile_cached(a.ds[uuid]['url_fun_python'], "<url_fun_python: " + uuid + ">"), namespace)
+    return namespace["url_current"]
 
 # define Downloader class
 class Downloader:
     def __init__(self, uuid):
         # set retry count
         self.retry = -1 # initial try sets count to 0
+        # copy of the downloaded file to keep as the base of the next delta (see prepare_delta())
+        self.delta_base_pending = None
+        # duration and outcome of the download, recorded once the upload outcome is known (see record_run_stats())
+        self.run_stats_lock = threading.Lock()
+        self.run_stats = None
+        self.stored = None
+        self.run_stats_recorded = False
         # get UUID info
         self.uuid_info = self.get_dataset_info(uuid)
         # wait before beginning download (0 seconds by default)
@@ -32,28 +53,6 @@ class Downloader:
         self.dl_fun(self.uuid_info)
     
     # define methods
-    def arg_bool(self, k, v):
-        try:
-            if v == "True":
-                return True
-            elif v == "False":
-                return False
-            else:
-                raise ValueError
-        except:
-            print("Error interpreting arg " + k + ", setting value to False.")
-            return False
-
-    def arg_int(self, k, v):
-        try:
-            if k == "min_size":
-                return parse_size(v)
-            else:
-                return(int(v))
-        except:
-            print("Error interpreting arg " + k + ", setting value to 0.")
-            return 0
-    
     def get_dataset_info(self, uuid):
         d = a.ds[uuid]
         uuid_info = {"uuid": uuid}
@@ -63,16 +62,20 @@ class Downloader:
         # report ID name
         print(d["id_name"])
         # get URL
+        if "url" not in d and uuid in a.prefetching and not a.prefetching[uuid].is_set():
+            # URL function from --prefetch is still running; wait for it rather than running it again
+            print(uuid + ": Waiting for prefetched URL...")
+            a.prefetching[uuid].wait(a.config["downloading"].get("prefetch_timeout", 60))
         if "url" in d:
             uuid_info["url"] = d["url"]
+        elif "url_fun_python" in d and uuid in a.resolved_urls:
+            # use URL resolved before downloads began (--prefetch)
+            uuid_info["url"] = a.resolved_urls[uuid]
+            print(uuid + ", prefetched URL: " + uuid_info["url"]) # print result
         elif "url_fun_python" in d:
             # try to run URL function
             try:
-                # create local namespace
-                loc = {}
-                # execute url_fun_python, which returns the URL as url_current in the local namespace
-                exec(d['url_fun_python'], {}, loc)
-                uuid_info["url"] = loc["url_current"]
+                uuid_info["url"] = resolve_url(uuid)
                 print(uuid + ", retrieved URL: " + uuid_info["url"]) # print result
             except Exception as e:
                 # print error message
@@ -83,67 +86,27 @@ class Downloader:
                 uuid_info["url"] = "ERROR"
         else:
             raise Exception(uuid + ": Neither a URL nor a URL function are given, skipping...")
-        # get file name, path and extension
-        uuid_info["file_name"] = d["file_name"]
-        uuid_info["file_path"] = os.path.join(d["dir_parent"], d["dir_file"], uuid_info["file_name"])
-        uuid_info["file_ext"] = "." + d["file_ext"]
-        # process other arguments
-        uuid_info["args"] = {}
-        # process bool args
-        bool_args = [
-            "user", "rand_url", "verify",
-            "legacy_ssl", "unzip", "js"
-            ]
-        for k, v in d["args"].items():
-            if k in bool_args:
-                uuid_info["args"][k] = self.arg_bool(k, v)
-        # process int args
-        int_args = [
-            "wait", "min_size", "width", "height"
-            ]
-        for k, v in d["args"].items():
-            if k in int_args:
-                uuid_info["args"][k] = self.arg_int(k, v)
-        # download function
-        uuid_info["dl_fun"] = d["dl_fun"]
-        # use dl_file instead of html_page for simple HTML pages (pages not requiring JS)
-        if uuid_info["dl_fun"] == "html_page":
-            if "js" in uuid_info["args"]:
-                if uuid_info["args"]["js"] is False:
-                    uuid_info["dl_fun"] = "dl_file"
-                    uuid_info["args"].pop("js", None) # dl_file will not accept this arg
-                else:
-                    pass
-            else:
-                uuid_info["dl_fun"] = "dl_file"
-        # filter out unwanted keywords
-        if uuid_info["dl_fun"] == "html_page":
-            uuid_info["args"].pop("verify", None) # html_page will not accept this arg
+        # get file name, path, extension, typed args and download function from the catalog (see utils.catalog)
+        if uuid not in a.catalog["info"]:
+            raise Exception(uuid + ": Invalid dataset entry, skipping...")
+        info = a.catalog["info"][uuid]
+        uuid_info.update(info)
+        uuid_info["args"] = dict(info["args"])
         # return processed dataset information
         return uuid_info
     
-    def print_md5(self, f_content):
-        try:
-            print("md5: " + hashlib.md5(f_content).hexdigest())
-        except Exception as e:
-            # print error message
-            print(e)
-            # print failure to produce hash
-            print("md5: failed to hash dataset")
-    def index_entry(self, uuid, f_name_index, f_timestamp, f_path):
-        # get file size
-        f_size = os.path.getsize(f_path)
-        # get file md5
-        f_md5 = hashlib.md5(open(f_path, 'rb').read()).hexdigest()
+    def print_md5(self, f_md5):
+        print("md5: " + f_md5)
+
+    def index_entry(self, uuid, f_name_index, f_timestamp, f_path, f_md5 = None, f_size = None):
+        # get file md5 and size, if not already calculated while downloading
+        if f_md5 is None or f_size is None:
+            f_md5, f_size = md5_file(f_path)
         # extract date and convert timestamp
-        tz = a.config["project"]["tz"]
-        f_timestamp = pd.to_datetime(f_timestamp, format='%Y-%m-%d_%H-%M').tz_localize(tz=tz)
-        f_date = str(f_timestamp.date())
-        f_timestamp = f_timestamp.value / 10**9
-        # check if file is a duplicate using db
-        db = a.index
-        query = db.execute("SELECT COUNT(*) FROM archive WHERE uuid = ? AND file_md5 = ? AND file_size = ?", (uuid, f_md5, f_size))
-        f_duplicate = 1 if query.fetchone()[0] > 0 else 0
+        f_date = f_timestamp[:10]
+        f_timestamp = timestamp_to_epoch(f_timestamp, a.config["project"]["tz"])
+        # check if file is a duplicate using the known files in the index
+        f_duplicate = 1 if a.is_known_file(uuid, f_md5, f_size) else 0
         # create index entry
         f_index = {
             "uuid": uuid,
@@ -152,18 +115,45 @@ class Downloader:
             "file_date": f_date,
             "file_duplicate": f_duplicate,
             "file_size": f_size,
-            "file_md5": f_md5
+            "file_md5": f_md5,
+            "file_key": None,
+            "file_base": None,
+            "file_chain": 0,
+            "file_encoding": None,
+            "file_stored_size": None,
+            "file_offset": None
             }
         # return index entry
         return f_index
+
+    def index_entry_not_modified(self, uuid, f_name_index, f_timestamp):
+        # create index entry for a file that has not changed since the last download (i.e., a duplicate)
+        with a.index_lock:
+            row = a.index.execute("SELECT file_md5, file_size FROM archive WHERE uuid = ? ORDER BY file_timestamp DESC LIMIT 1", (uuid,)).fetchone()
+        if row is None:
+            raise Exception("Server reported file as not modified, but no previous download was found in the index")
+        return self.index_entry(uuid, f_name_index, f_timestamp, None, row[0], row[1])
     
-    def insert_index(self, f_index):
-        # insert index entry into database
-        a.index["archive"].insert(f_index)
+    def insert_index(self, f_index, validators = None):
+        # queue index entry to be written to the database at the end of the run
+        a.queue_index("archive", f_index)
+        # record validators for conditional requests
+        if validators is not None:
+            a.set_http_validators(f_index["uuid"], validators)
     
-    def upload_file(self, f_name, f_path, uuid, f_index):
+    def upload_file(self, f_name, f_path, uuid, f_index, validators = None, tmpdir = None):
         # generate full S3 key
         f_key = os.path.join(a.s3["bucket_root"], f_name)
+        # insert index entry and record success (called once the file is on S3)
+        def on_success():
+            self.insert_index(f_index, validators)
+            self.keep_delta_base(uuid, f_index)
+            a.record_success(f_name)
+            self.record_run_stats(stored = True)
+        def on_failure():
+            self.keep_delta_base(uuid, f_index, stored = False)
+            a.record_failure(f_name, uuid)
+            self.record_run_stats(stored = False)
         # upload file to S3
         try:
             # upload file
@@ -172,18 +162,166 @@ class Downloader:
                 if a.debug_options["no_upload"]:
                     print("DEBUG: Skipping upload...")
                 else:
-                    a.s3["bucket"].upload_file(Filename=f_path, Key=f_key)
+                    # content-addressed storage: store each file once, by its hash
+                    if a.config.get("storage", {}).get("content_addressed", False):
+                        stored = a.find_stored_copy(f_index["file_md5"], f_index["file_size"])
+                        if stored is not None:
+                            # reference the stored copy instead of uploading the file again
+                            print("File is already stored as " + stored["file_key"] + ". Skipping upload...")
+                            f_index.update(stored)
+                            on_success()
+                            return
+                    # delta storage: store text files as a delta against the previous version
+                    delta_path = self.prepare_delta(uuid, f_path, f_index, tmpdir)
+                    if delta_path is not None:
+                        f_path = delta_path
+                        f_index["file_key"] = f_name + ".delta"
+                        f_key = os.path.join(a.s3["bucket_root"], f_index["file_key"])
+                    elif a.config.get("storage", {}).get("content_addressed", False):
+                        f_index["file_key"] = blob_key(f_index["file_md5"], f_index["file_size"])
+                        f_key = os.path.join(a.s3["bucket_root"], f_index["file_key"])
+                    # compression: compress text files, setting Content-Encoding so public links still work
+                    extra_args = {}
+                    content_type = "application/json" if delta_path is not None else mimetypes.guess_type(f_name)[0]
+                    if content_type is not None:
+                        extra_args["ContentType"] = content_type
+                    f_path = self.compress(f_path, f_index, tmpdir, extra_args)
+                    f_index["file_stored_size"] = os.path.getsize(f_path)
+                    # record MD5 hash and size of the original file (and the base of a delta) on objects that store it
+                    # compressed or as a delta, so the index can be rebuilt from S3 (see Archivist.initialize_index)
+                    if f_index["file_encoding"] is not None or f_index["file_base"] is not None:
+                        extra_args["Metadata"] = {"md5": f_index["file_md5"], "size": str(f_index["file_size"])}
+                        if f_index["file_base"] is not None:
+                            extra_args["Metadata"].update({"base": f_index["file_base"], "chain": str(f_index["file_chain"])})
+                    # bundling: add small files to the bundle of this run instead of uploading them individually
+                    storage = a.config.get("storage", {})
+                    if storage.get("bundle", False) and f_index["file_stored_size"] < parse_size(str(storage.get("bundle_threshold", "64 KiB"))):
+                        up.add_to_bundle(f_path, f_index, on_success, on_failure)
+                        return
+                    # queue upload; the index entry is inserted after the upload is confirmed
+                    up.submit(f_path, f_key, tmpdir, on_success, on_failure, extra_args)
+                    return
             else:
                 print("File is a duplicate. Skipping upload...")
-            # insert index entry and record success
-            self.insert_index(f_index)
-            a.record_success(f_name)
+            on_success()
         except Exception as e:
             # print error message
             print(e)
             # record failure
-            a.record_failure(f_name, uuid)
+            on_failure()
     
+    def compress(self, f_path, f_index, tmpdir, extra_args):
+        """Compress a file before upload, if compression applies.
+
+        Compression is enabled by compress in the [storage] section of config.toml or the compress
+        arg of a dataset ("gzip", "zstd" or "none") and applies to files with extensions in
+        compress_exts. Files that do not become smaller are stored uncompressed. The MD5 hash and
+        size in the index remain those of the uncompressed file.
+
+        Returns:
+        str: Path to the file to upload.
+        """
+        storage = a.config.get("storage", {})
+        encoding = self.uuid_info["args"]["compress"] if "compress" in self.uuid_info["args"] else storage.get("compress", "none")
+        if not encoding or encoding == "none" or tmpdir is None:
+            return f_path
+        if self.uuid_info["file_ext"].lstrip(".") not in storage.get("compress_exts", ["csv", "json", "html", "txt"]):
+            return f_path
+        c_path = os.path.join(tmpdir.name, "compressed")
+        compress_file(f_path, c_path, encoding, storage.get("compress_level", None))
+        # small files can grow when compressed
+        if os.path.getsize(c_path) >= os.path.getsize(f_path):
+            os.remove(c_path)
+            return f_path
+        f_index["file_encoding"] = encoding
+        extra_args["ContentEncoding"] = encoding
+        print("Compressed file with " + encoding + " (" + format_size(os.path.getsize(f_path)) + " to " + format_size(os.path.getsize(c_path)) + ")...")
+        return c_path
+
+    def prepare_delta(self, uuid, f_path, f_index, tmpdir):
+        """Write a delta of a file against the previous version of the dataset, if delta storage applies.
+
+        Delta storage is enabled by delta in the [storage] section of config.toml (or the delta arg
+        of a dataset) and applies to files with extensions in delta_exts up to delta_max_size.
+        A full version (keyframe) is stored every keyframe_interval versions, or when the delta is
+        not much smaller than the file. The last version of each dataset is kept in the index cache
+        directory (see delta_base_dir()), so the base does not have to be reconstructed from S3.
+
+        Returns:
+        str: Path to the delta, or None if the file should be stored in full.
+        """
+        storage = a.config.get("storage", {})
+        delta = self.uuid_info["args"]["delta"] if "delta" in self.uuid_info["args"] else storage.get("delta", False)
+        if not delta or tmpdir is None:
+            return None
+        if self.uuid_info["file_ext"].lstrip(".") not in storage.get("delta_exts", ["csv", "json", "html", "txt"]):
+            return None
+        max_size = parse_size(str(storage.get("delta_max_size", "20 MiB")))
+        if f_index["file_size"] > max_size:
+            return None
+        # keep this version as the base of the next version, once it is stored (see keep_delta_base())
+        os.makedirs(self.delta_base_dir(uuid), exist_ok=True)
+        self.delta_base_pending = os.path.join(self.delta_base_dir(uuid), f_index["file_md5"] + "." + a.run_id + ".pending")
+        shutil.copyfile(f_path, self.delta_base_pending)
+        # get previous stored version
+        with a.index_lock:
+            base = list(a.index.query(
+                "SELECT * FROM archive WHERE uuid = ? AND file_duplicate = 0 ORDER BY file_timestamp DESC LIMIT 1", [uuid]))
+        if len(base) == 0 or base[0]["file_size"] > max_size:
+            return None
+        base = base[0]
+        chain = (base.get("file_chain") or 0) + 1
+        if chain >= storage.get("keyframe_interval", 10):
+            print("Storing full version (keyframe)...")
+            return None
+        # create delta
+        try:
+            base_path = os.path.join(self.delta_base_dir(uuid), base["file_md5"])
+            if not os.path.exists(base_path):
+                # reconstruct base from S3
+                base_path = os.path.join(tmpdir.name, "base")
+                with open(base_path, "wb") as local_file:
+                    local_file.write(read_file(resolve_file(base["file_name"], uuid)))
+            delta_content = make_delta(base_path, f_path, max_size = f_index["file_size"] / 2)
+        except Exception as e:
+            print(e)
+            print("Failed to create delta. Storing full version...")
+            return None
+        if delta_content is None or len(delta_content) > f_index["file_size"] / 2:
+            return None
+        delta_path = os.path.join(tmpdir.name, "delta")
+        with open(delta_path, "wb") as local_file:
+            local_file.write(delta_content)
+        f_index["file_base"] = base["file_name"]
+        f_index["file_chain"] = chain
+        print("Storing delta against " + base["file_name"] + " (" + format_size(len(delta_content)) + ")...")
+        return delta_path
+
+    def delta_base_dir(self, uuid):
+        # last stored version of a dataset, named by its MD5 hash
+        return os.path.join(a.index_cache_dir(), "delta_base", uuid)
+
+    def keep_delta_base(self, uuid, f_index, stored = True):
+        # keep the version just stored as the base of the next version, replacing the previous base
+        # (if the version could not be stored, discard it)
+        if self.delta_base_pending is None or not os.path.exists(self.delta_base_pending):
+            return
+        if not stored:
+            os.remove(self.delta_base_pending)
+            self.delta_base_pending = None
+            return
+        base_dir = self.delta_base_dir(uuid)
+        base_path = os.path.join(base_dir, f_index["file_md5"])
+        os.replace(self.delta_base_pending, base_path)
+        self.delta_base_pending = None
+        for f in os.listdir(base_dir):
+            # versions being stored by other runs end with .pending
+            if f != f_index["file_md5"] and not f.endswith(".pending"):
+                try:
+                    os.remove(os.path.join(base_dir, f))
+                except FileNotFoundError:
+                    pass
+
     def dl_fun(self, uuid_info):
         # get download function
         dl_fun = uuid_info["dl_fun"]
@@ -194,13 +332,19 @@ class Downloader:
         f_name = uuid_info["file_path"] + '_' + f_timestamp + uuid_info["file_ext"]
         f_name_index = uuid_info["file_name"] + '_' + f_timestamp + uuid_info["file_ext"]
         # begin download
+        t0 = time.monotonic()
+        attempts = 0
+        success = False
         while self.retry < a.config["downloading"]["max_retries"]:
+            attempts += 1
             try:
                 # announce retry
                 if self.retry >= 0:
                     print(background("Retry " + str(self.retry + 1) + "/" + str(a.config["downloading"]["max_retries"]) + " for " + uuid, Colors.orange))
-                # download file
-                getattr(self, dl_fun)(uuid_info, f_name, f_timestamp, f_name_index)
+                # download file (waiting if too many downloads from this host are in progress)
+                with a.host_limit(uuid_info["url"]):
+                    getattr(self, dl_fun)(uuid_info, f_name, f_timestamp, f_name_index)
+                success = True
                 break # function ran without exceptions
             except Exception as e:
                 # print error message
@@ -211,6 +355,32 @@ class Downloader:
                 if self.retry == a.config["downloading"]["max_retries"]:
                     # record failure
                     a.record_failure(f_name, uuid)
+        # record duration and outcome, used to order datasets in later runs
+        self.record_run_stats({"uuid": uuid, "url": uuid_info["url"], "dl_fun": dl_fun, "duration": time.monotonic() - t0, "attempts": attempts, "success": success})
+
+    def record_run_stats(self, stats = None, stored = None):
+        """Record the duration and outcome of the download in the run_stats table (prod runs only).
+
+        Uploads are queued (see Uploader), so a download only counts as a success once its file
+        is stored. This is called by dl_fun() with the duration and outcome of the download and by
+        the upload callbacks with whether the file was stored, in either order, and records the
+        stats once both are known.
+        """
+        if a.options["mode"] != "prod":
+            return
+        with self.run_stats_lock:
+            if stats is not None:
+                self.run_stats = stats
+            # keep the first upload outcome
+            if stored is not None and self.stored is None:
+                self.stored = stored
+            if self.run_stats is None or self.run_stats_recorded:
+                return
+            if self.run_stats["success"] and self.stored is None:
+                return
+            self.run_stats_recorded = True
+            stats = dict(self.run_stats, success = self.run_stats["success"] and self.stored)
+        a.record_run_stats(**stats)
 
     def dl_file(self, uuid_info, f_name, f_timestamp, f_name_index):
         # set UUID and URL
@@ -248,49 +418,55 @@ class Downloader:
         if rand_url is True:
             url = url + "?randNum=" + str(int(datetime.now().timestamp()))
 
-        # request URL
+        # make request conditional on the file having changed since the last download (prod only)
+        if a.options["mode"] == "prod":
+            last_validators = a.get_http_validators(uuid)
+            if last_validators is not None:
+                if last_validators["etag"]:
+                    headers["If-None-Match"] = last_validators["etag"]
+                if last_validators["last_modified"]:
+                    headers["If-Modified-Since"] = last_validators["last_modified"]
+
+        # request URL using the shared session for this host
         if legacy_ssl:
-            # workaround for unsafe_legacy_renegotiation error
-            # https://github.com/scrapy/scrapy/issues/5491#issuecomment-1241862323
-            class CustomHttpAdapter (requests.adapters.HTTPAdapter):
-                def __init__(self, ssl_context=None, **kwargs):
-                    self.ssl_context = ssl_context
-                    super().__init__(**kwargs)
-                def init_poolmanager(self, connections, maxsize, block=False):
-                    self.poolmanager = urllib3.poolmanager.PoolManager(
-                        num_pools=connections, maxsize=maxsize,
-                        block=block, ssl_context=self.ssl_context)
-            def get_legacy_session():
-                ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-                ctx.options |= 0x4  # OP_LEGACY_SERVER_CONNECT
-                session = requests.session()
-                session.mount('https://', CustomHttpAdapter(ctx))
-                return session
-            # make request
+            # workaround for unsafe_legacy_renegotiation error (see archivist.utils.http.LegacySSLAdapter)
             if (verify is False or a.debug_options["ignore_ssl"] or a.debug_options["force_ssl"]):
                 # if verify is False, get the following error: "Cannot set verify_mode to CERT_NONE when check_hostname is enabled."
                 print("WARNING: Ignoring settings for verify, ignore_ssl, and force_ssl when legacy_ssl is True.")
-            req = get_legacy_session().get(url, headers=headers, verify=True, timeout=5)
-        else:
-            req = requests.get(url, headers=headers, verify=verify, timeout=5)
+            verify = True
+        session = a.get_session(url, verify=verify, legacy_ssl=legacy_ssl)
+        req = session.get(url, headers=headers, verify=verify, timeout=5, stream=True)
 
         ## check if request was successful
         if not req.ok:
+            req.close()
             # raise exception
             raise Exception("Request failed")
+        # file has not changed since the last download: record duplicate without downloading
+        if req.status_code == 304:
+            req.close()
+            print("File has not been modified since the last download. Skipping download...")
+            f_index = self.index_entry_not_modified(uuid, f_name_index, f_timestamp)
+            self.upload_file(f_name, None, uuid, f_index)
+            return
+        # get validators for the next conditional request
+        validators = None
+        if req.headers.get("ETag") or req.headers.get("Last-Modified"):
+            validators = {"etag": req.headers.get("ETag"), "last_modified": req.headers.get("Last-Modified")}
+        # stream response to temporary file, calculating md5 hash and size in the same pass
+        # zip files are written to a separate file and unzipped below
+        z_path = os.path.join(tmpdir.name, "zip_file.zip")
+        with req:
+            f_md5, f_size = write_chunks(req.iter_content(chunk_size=CHUNK_SIZE), z_path if unzip else f_path)
         # check if page source is above minimum expected size
         if html and min_size:
-            size = len(req.text.encode("utf-8"))
-            if size < min_size:
+            if f_size < min_size:
                 # raise exception
-                raise Exception("Page source is below minimum expected size (actual size: " + format_size(size) +
+                raise Exception("Page source is below minimum expected size (actual size: " + format_size(f_size) +
                                 ", expected size: " + format_size(min_size) + ")")
         # DEBUG: print md5 hash of dataset
         if a.debug_options["print_md5"]:
-            if html:
-                self.print_md5(req.text.encode("utf-8"))
-            else:
-                self.print_md5(req.content)
+            self.print_md5(f_md5)
         # successful request: if mode == test, print success and end
         if a.options["mode"] == "test":
             # record success
@@ -299,20 +475,14 @@ class Downloader:
         else:
             # unzip file, if required
             if unzip:
-                # unzip data
-                z_path = os.path.join(tmpdir.name, "zip_file.zip")
-                with open(z_path, mode="wb") as local_file:
-                    local_file.write(req.content)
                 with ZipFile(z_path, "r") as zip_file:
                     zip_file.extractall(tmpdir.name)
-            else:
-                # all other data: write contents to temporary file
-                with open(f_path, mode="wb") as local_file:
-                    local_file.write(req.content)
+                # md5 hash and size will be calculated from the unzipped file
+                f_md5, f_size = None, None
             # prepare index entry
-            f_index = self.index_entry(uuid, f_name_index, f_timestamp, f_path)
+            f_index = self.index_entry(uuid, f_name_index, f_timestamp, f_path, f_md5, f_size)
             # upload file if file is not a duplicate then insert index entry
-            self.upload_file(f_name, f_path, uuid, f_index)
+            self.upload_file(f_name, f_path, uuid, f_index, validators, tmpdir)
 
     def html_page(self, uuid_info, f_name, f_timestamp, f_name_index):
 
@@ -328,24 +498,26 @@ class Downloader:
         # user = uuid_info["args"]["user"] if "user" in uuid_info["args"] else False
         wait = uuid_info["args"]["wait"] if "wait" in uuid_info["args"] else 0
         min_size = uuid_info["args"]["min_size"] if "min_size" in uuid_info["args"] else False
+        ready_css = uuid_info["args"]["ready_css"] if "ready_css" in uuid_info["args"] else None
+        wait_fixed = uuid_info["args"]["wait_fixed"] if "wait_fixed" in uuid_info["args"] else False
 
         # download file
-        # load page and get source
-        driver = Webdriver(tmpdir, uuid, url, wait)
-        page_source = driver.page_source()
+        # load page in a browser borrowed from the pool and get source
+        with wp.borrow(tmpdir) as driver:
+            t_ready = driver.load(uuid, url, wait, ready_css=ready_css, wait_fixed=wait_fixed)
+            print(uuid + ": page ready after " + str(round(t_ready, 1)) + " seconds (max wait: " + str(wait) + " seconds)")
+            page_source = driver.page_source()
+        # save HTML file, calculating md5 hash and size in the same pass
+        f_md5, f_size = write_chunks([page_source.encode("utf-8")], f_path)
         # check if page source is above minimum expected size
         if min_size:
-            size = len(page_source.encode("utf-8"))
-            if size < min_size:
+            if f_size < min_size:
                 # raise exception
-                raise Exception("Page source is below minimum expected size (actual size: " + format_size(size) +
+                raise Exception("Page source is below minimum expected size (actual size: " + format_size(f_size) +
                                 ", expected size: " + format_size(min_size) + ")")
         # DEBUG: print md5 hash of dataset
         if a.debug_options["print_md5"]:
-            self.print_md5(page_source.encode("utf-8"))
-        # save HTML file
-        with open(f_path, "w") as local_file:
-            local_file.write(page_source)
+            self.print_md5(f_md5)
         # verify download
         if not os.path.isfile(f_path):
             # raise exception
@@ -357,8 +529,6 @@ class Downloader:
         # successful request: mode == prod, prepare files for data upload
         else:
             # prepare index entry
-            f_index = self.index_entry(uuid, f_name_index, f_timestamp, f_path)
+            f_index = self.index_entry(uuid, f_name_index, f_timestamp, f_path, f_md5, f_size)
             # upload file if file is not a duplicate then insert index entry
-            self.upload_file(f_name, f_path, uuid, f_index)
-        # quit webdriver
-        driver.quit()
+            self.upload_file(f_name, f_path, uuid, f_index, tmpdir=tmpdir)
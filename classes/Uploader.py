@@ -0,0 +1,140 @@
+# import modules
+import os
+import threading
+import tempfile
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+from humanfriendly import parse_size
+
+# import classes
+from archivist.classes.Archivist import Archivist as a
+
+# define Uploader class
+class Uploader:
+    """Background queue for S3 uploads, so the next dataset can be downloaded while files are uploaded.
+
+    Transfer settings are set in the [uploading] section of config.toml:
+    multipart_threshold, multipart_chunksize, max_concurrency (threads per upload),
+    queue_workers (parallel uploads) and queue_size (maximum files waiting to be uploaded).
+
+    Small files can also be added to a bundle, which is uploaded as a single object when the
+    queue is drained (see add_to_bundle()).
+    """
+    def __init__(self):
+        config = a.config.get("uploading", {})
+        self._transfer_config = None
+        self.executor = ThreadPoolExecutor(max_workers = config.get("queue_workers", 4))
+        # limit number of files waiting to be uploaded (each holds a temporary directory)
+        self.slots = threading.BoundedSemaphore(config.get("queue_size", 16))
+        self.lock = threading.Lock()
+        self.futures = []
+        # bundle of small files for this run
+        self.bundle_lock = threading.Lock()
+        self.bundle = None
+
+    @property
+    def transfer_config(self):
+        # created on first upload to avoid importing boto3 at startup
+        if self._transfer_config is None:
+            from boto3.s3.transfer import TransferConfig
+            config = a.config.get("uploading", {})
+            self._transfer_config = TransferConfig(
+                multipart_threshold = parse_size(str(config.get("multipart_threshold", "8 MiB"))),
+                multipart_chunksize = parse_size(str(config.get("multipart_chunksize", "8 MiB"))),
+                max_concurrency = config.get("max_concurrency", 10))
+        return self._transfer_config
+
+    def submit(self, f_path, f_key, tmpdir, on_success, on_failure, extra_args = None):
+        """Queue a file for upload.
+
+        Parameters:
+        f_path (str): Path to the file.
+        f_key (str): S3 key to upload the file to.
+        tmpdir (TemporaryDirectory): Temporary directory holding the file, cleaned up after the upload.
+        on_success (function): Called after the upload is confirmed (e.g., to insert the index entry).
+        on_failure (function): Called if the upload fails.
+        extra_args (dict): Optional. Extra arguments for the upload (e.g., ContentEncoding).
+        """
+        self.slots.acquire()
+        future = self.executor.submit(self.upload, f_path, f_key, tmpdir, on_success, on_failure, extra_args)
+        with self.lock:
+            self.futures.append(future)
+
+    def upload(self, f_path, f_key, tmpdir, on_success, on_failure, extra_args = None):
+        try:
+            a.s3["bucket"].upload_file(Filename=f_path, Key=f_key, ExtraArgs=extra_args, Config=self.transfer_config)
+            on_success()
+        except Exception as e:
+            # print error message
+            print(e)
+            on_failure()
+        finally:
+            if tmpdir is not None:
+                tmpdir.cleanup()
+            self.slots.release()
+
+    def add_to_bundle(self, f_path, f_index, on_success, on_failure):
+        """Append a small file to the bundle of this run.
+
+        The key of the bundle and the offset of the file are recorded in f_index (file_key and
+        file_offset; the length is file_stored_size). The callbacks are called when the bundle
+        is uploaded by drain().
+        """
+        with self.bundle_lock:
+            if self.bundle is None:
+                # e.g., bundles/2021/01/31/2021-01-31_12-00-00.bundle, based on the start time of the run
+                t = datetime.strptime(a.t[:19], "%Y-%m-%d %H:%M:%S")
+                tmpdir = tempfile.TemporaryDirectory()
+                self.bundle = {
+                    "tmpdir": tmpdir,
+                    "path": os.path.join(tmpdir.name, "bundle"),
+                    "key": os.path.join("bundles", t.strftime("%Y/%m/%d/%Y-%m-%d_%H-%M-%S") + ".bundle"),
+                    "size": 0,
+                    "callbacks": []
+                }
+            with open(f_path, "rb") as f_data, open(self.bundle["path"], "ab") as bundle_file:
+                data = f_data.read()
+                bundle_file.write(data)
+            f_index["file_key"] = self.bundle["key"]
+            f_index["file_offset"] = self.bundle["size"]
+            f_index["file_stored_size"] = len(data)
+            self.bundle["size"] += len(data)
+            self.bundle["callbacks"].append((on_success, on_failure))
+
+    def upload_bundle(self):
+        # upload bundle of small files, then record the files in it
+        with self.bundle_lock:
+            bundle = self.bundle
+            self.bundle = None
+        if bundle is None:
+            return
+        print("Uploading bundle of " + str(len(bundle["callbacks"])) + " small files...")
+        try:
+            a.s3["bucket"].upload_file(Filename=bundle["path"], Key=os.path.join(a.s3["bucket_root"], bundle["key"]),
+                                       ExtraArgs={"ContentType": "application/octet-stream"}, Config=self.transfer_config)
+            print("Successfully uploaded bundle.")
+            success = True
+        except Exception as e:
+            print(e)
+            print("Failed to upload bundle.")
+            success = False
+        for on_success, on_failure in bundle["callbacks"]:
+            if success:
+                on_success()
+            else:
+                on_failure()
+        bundle["tmpdir"].cleanup()
+
+    def drain(self):
+        # wait for all queued uploads to finish
+        with self.lock:
+            futures = self.futures
+            self.futures = []
+        if len(futures) > 0:
+            print("Waiting for " + str(sum(1 for f in futures if not f.done())) + " uploads to finish...")
+            wait(futures)
+        # upload bundle of small files
+        self.upload_bundle()
+
+# create Uploader object
+Uploader = Uploader()
@@ -1,19 +1,44 @@
 # import modules
 import os
 import time
-from selenium import webdriver # requires ChromeDriver and Chromium/Chrome
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
+import threading
+from contextlib import contextmanager
+# selenium is imported when a browser is first needed, to keep startup fast
+# (requires ChromeDriver and Chromium/Chrome)
 
 # import classes
 from archivist.classes.Archivist import Archivist as a
 
+# script recording the time of the last DOM mutation and returning the state of the page
+# (the resource timing buffer holds 250 entries by default, after which new requests are not counted)
+READY_STATE_JS = """
+if (!window.__archivist_mutation) {
+    performance.setResourceTimingBufferSize(100000);
+    window.__archivist_mutation = Date.now();
+    new MutationObserver(function() { window.__archivist_mutation = Date.now(); }).observe(
+        document, {subtree: true, childList: true, attributes: true, characterData: true});
+}
+return [document.readyState, performance.getEntriesByType("resource").length, Date.now() - window.__archivist_mutation];
+"""
+
+# define functions
+def selenium_helpers():
+    """Import selenium helpers, which are also made available to special processing code.
+
+    selenium is imported when a browser is first needed, to keep startup fast.
+    """
+    from selenium import webdriver
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.common.by import By
+    return {"webdriver": webdriver, "WebDriverWait": WebDriverWait, "EC": EC, "By": By}
+
 # define Webdriver class
 class Webdriver:
-    def __init__(self, tmpdir, uuid, url, wait):
+    def __init__(self):
+        from selenium import webdriver
+        from selenium.webdriver.chrome.service import Service
+        from selenium.webdriver.chrome.options import Options
         # load webdriver
         options = Options()
         options.binary_location = os.environ['CHROME_BIN']
@@ -21,47 +46,123 @@ class Webdriver:
         options.add_argument("--start-maximized")
         options.add_argument("--disable-dev-shm-usage")
         options.add_argument("--no-sandbox")
-        prefs = {'download.default_directory' : tmpdir.name}
-        options.add_experimental_option('prefs', prefs)
         chromedriver_service = Service(os.environ['CHROMEDRIVER_BIN'])
         self.wd = webdriver.Chrome(service=chromedriver_service, options=options)
+        # number of datasets loaded by this instance
+        self.uses = 0
+
+    def reset(self, tmpdir):
+        # open a fresh tab and close all others
+        old_handles = self.wd.window_handles
+        self.wd.switch_to.new_window("tab")
+        new_handle = self.wd.current_window_handle
+        for handle in old_handles:
+            self.wd.switch_to.window(handle)
+            self.wd.close()
+        self.wd.switch_to.window(new_handle)
+        # clear cookies and cache left by the previous dataset (for all sites, not only the current one)
+        self.wd.execute_cdp_cmd("Network.clearBrowserCookies", {})
+        self.wd.execute_cdp_cmd("Network.clearBrowserCache", {})
+        # download files to the directory for this dataset
+        self.wd.execute_cdp_cmd("Page.setDownloadBehavior", {"behavior": "allow", "downloadPath": tmpdir.name})
+
+    def load(self, uuid, url, wait, ready_css = None, wait_fixed = False):
         # load page
+        t0 = time.monotonic()
         self.wd.get(url)
         # run special processing code, if required
         self.special_processing(uuid, wait)
         # wait for page to load
-        time.sleep(wait) # complete page load
+        if wait_fixed:
+            time.sleep(wait) # complete page load
+        else:
+            self.wait_until_ready(wait, ready_css)
+        # return time taken for page to become ready
+        return time.monotonic() - t0
+
+    def wait_until_ready(self, wait, ready_css = None):
+        """Wait until the page appears to be ready, for at most wait seconds.
+
+        This is a heuristic: the page is taken to be ready when the document has finished loading,
+        no network request has completed and the DOM has not changed for quiet_period seconds (set
+        in the [webdriver] section of config.toml) and, if ready_css is given, an element matching
+        this CSS selector is present. Requests are counted from the resource timing entries of the
+        page, which are only added when a request completes, so a slow request that is still in
+        flight is not seen. Use ready_css (or wait_fixed) for pages where this matters.
+        """
+        if wait <= 0:
+            return True
+        By = selenium_helpers()["By"]
+        quiet_period = a.config.get("webdriver", {}).get("quiet_period", 1)
+        deadline = time.monotonic() + wait
+        n_resources = None
+        resources_changed = time.monotonic()
+        while time.monotonic() < deadline:
+            try:
+                ready_state, n, mutation_age = self.wd.execute_script(READY_STATE_JS)
+            except Exception:
+                # page may be navigating; try again
+                time.sleep(0.25)
+                continue
+            # track time of last completed network request
+            if n != n_resources:
+                n_resources = n
+                resources_changed = time.monotonic()
+            ready = (ready_state == "complete" and
+                     mutation_age >= quiet_period * 1000 and
+                     time.monotonic() - resources_changed >= quiet_period)
+            if ready and ready_css:
+                ready = len(self.wd.find_elements(By.CSS_SELECTOR, ready_css)) > 0
+            if ready:
+                return True
+            time.sleep(0.25)
+        print("Page did not become ready within " + str(wait) + " seconds. Continuing...")
+        return False
+
+    def alive(self):
+        # check if browser is still responding
+        try:
+            self.wd.window_handles
+            return True
+        except Exception:
+            return False
 
     def page_source(self):
         return self.wd.page_source
     
     def special_processing(self, uuid, wait):
-        proc_webdriver_path = os.path.join(a.options["project_dir"], "proc", "webdriver", uuid + ".py")
-        if os.path.exists(proc_webdriver_path):
+        # code is compiled when datasets are loaded (see Archivist.compile_ds_code)
+        proc_webdriver_code = a.proc_webdriver.get(uuid)
+        if proc_webdriver_code is not None:
             try:
-                # run code in current namespace
-                proc_webdriver_code = open(proc_webdriver_path)
-                exec(proc_webdriver_code.read())
-                proc_webdriver_code.close()
+                if isinstance(proc_webdriver_code, SyntaxError):
+                    raise proc_webdriver_code
+                # run code in a single namespace with the module globals, selenium helpers and
+                # the current driver, so functions defined in the code can also see these names
+                namespace = dict(globals())
+                namespace.update(selenium_helpers())
+                namespace.update({"self": self, "uuid": uuid, "wait": wait})
+                exec(proc_webdriver_code, namespace)
             # print error message
             except Exception as e:
                 print(e)
                 raise Exception("Error in special processing code for webdriver: " + uuid)
     
-    def click_css(self, wait, css):
-        element = WebDriverWait(self.wd, timeout=wait).until(
-            EC.element_to_be_clickable((By.CSS_SELECTOR, css)))
+    def click(self, wait, by, value):
+        # wait for an element to be clickable (by is an attribute of selenium's By, e.g., "CSS_SELECTOR") and click it
+        helpers = selenium_helpers()
+        element = helpers["WebDriverWait"](self.wd, timeout=wait).until(
+            helpers["EC"].element_to_be_clickable((getattr(helpers["By"], by), value)))
         element.click()
 
+    def click_css(self, wait, css):
+        self.click(wait, "CSS_SELECTOR", css)
+
     def click_xpath(self, wait, xpath):
-        element = WebDriverWait(self.wd, timeout=wait).until(
-            EC.element_to_be_clickable((By.XPATH, xpath)))
-        element.click()
+        self.click(wait, "XPATH", xpath)
 
     def click_linktext(self, wait, text):
-        element = WebDriverWait(self.wd, timeout=wait).until(
-            EC.element_to_be_clickable((By.LINK_TEXT, text)))
-        element.click()
+        self.click(wait, "LINK_TEXT", text)
     
     def quit(self):
         self.wd.quit()
@@ -77,4 +178,74 @@ class Webdriver:
             else:
                 print("HELLO")
                 getattr(self.wd, name)
-        return method
\ No newline at end of file
+        return method
+
+# define WebdriverPool class
+class WebdriverPool:
+    """Pool of long-lived browser instances shared by html_page downloads.
+
+    The number of instances is limited to the number of download workers. Instances are
+    recycled after max_uses datasets (set in the [webdriver] section of config.toml) or
+    if the browser stops responding.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = []
+        self.slots = threading.BoundedSemaphore(max(a.options.get("workers", 1), 1))
+        self.max_uses = a.config.get("webdriver", {}).get("max_uses", 25)
+
+    @contextmanager
+    def borrow(self, tmpdir):
+        """Borrow a browser with a fresh tab, downloading files to tmpdir."""
+        with self.slots:
+            # reuse an idle browser, if available
+            with self.lock:
+                driver = self.idle.pop() if len(self.idle) > 0 else None
+            if driver is not None:
+                try:
+                    driver.reset(tmpdir)
+                except Exception as e:
+                    print(e)
+                    print("Browser failed to reset. Starting a new browser...")
+                    self.discard(driver)
+                    driver = None
+            if driver is None:
+                driver = Webdriver()
+                try:
+                    driver.reset(tmpdir)
+                except Exception:
+                    # quit the new browser, so Chrome and ChromeDriver do not keep running
+                    self.discard(driver)
+                    raise
+            # lend browser
+            healthy = True
+            try:
+                yield driver
+            except Exception:
+                healthy = driver.alive()
+                raise
+            finally:
+                # return browser to pool or recycle it
+                driver.uses += 1
+                if healthy and driver.uses < self.max_uses:
+                    with self.lock:
+                        self.idle.append(driver)
+                else:
+                    self.discard(driver)
+
+    def discard(self, driver):
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def close(self):
+        # quit all idle browsers
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for driver in idle:
+            self.discard(driver)
+
+# create WebdriverPool object
+WebdriverPool = WebdriverPool()
@@ -14,5 +14,5 @@ setup(
     author='Jean-Paul R. Soucy',
     author_email="<jeanpaul.r.soucy@gmail.com>",
     license='MIT',
-    install_requires=['boto3', 'bs4', 'color-it', 'humanfriendly', 'pandas', 'pytz', 'requests', 'selenium', 'sqlite-utils', 'toml'],
+    install_requires=['boto3', 'bs4', 'color-it', 'humanfriendly', 'pytz', 'requests', 'selenium', 'sqlite-utils', 'toml'],
 )
@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import gzip
+import shutil
+import time
+import socket
+import threading
+import subprocess
+import pytest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# shared fixtures for tests that run archivist through __main__ (python -m archivist)
+# tests using S3 run against a local moto server and are skipped if moto is not installed,
+# datasets are downloaded from a local HTTP server
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sample")
+BUCKET = "archivist-test"
+ROOT = "archive"
+UUID = "11111111-1111-1111-1111-111111111111"
+
+def dataset(uuid = UUID, **kwargs):
+    d = {
+        "id_name": "Cases",
+        "uuid": uuid,
+        "active": "True",
+        "url": "https://example.com/cases.csv",
+        "dir_parent": "can",
+        "dir_file": "cases",
+        "file_name": "cases",
+        "file_ext": "csv",
+        "dl_fun": "dl_file",
+        "args": {}
+        }
+    d.update(kwargs)
+    return d
+
+def archive_row(file_name, file_timestamp, file_md5, file_size, uuid = UUID, file_duplicate = 0):
+    return {
+        "uuid": uuid,
+        "file_name": file_name,
+        "file_timestamp": file_timestamp,
+        "file_date": file_name[-20:-10],
+        "file_duplicate": file_duplicate,
+        "file_md5": file_md5,
+        "file_size": file_size
+        }
+
+@pytest.fixture
+def project(tmp_path):
+    """Project directory with the sample config.toml and a single dataset."""
+    project_dir = tmp_path / "project"
+    project_dir.mkdir()
+    shutil.copy(os.path.join(SAMPLE_DIR, "config.toml"), project_dir / "config.toml")
+    with open(project_dir / "datasets.json", "w") as ds_file:
+        json.dump({"active": {"can": [dataset()]}, "inactive": {"can": []}}, ds_file)
+    return str(project_dir)
+
+@pytest.fixture(scope = "session")
+def s3_endpoint():
+    server = pytest.importorskip("moto.server")
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    moto = server.ThreadedMotoServer(ip_address = "127.0.0.1", port = port, verbose = False)
+    moto.start()
+    yield "http://127.0.0.1:" + str(port)
+    moto.stop()
+
+@pytest.fixture
+def bucket(s3_endpoint):
+    """Empty bucket on the local S3 server."""
+    import boto3
+    s3 = boto3.resource("s3", endpoint_url = s3_endpoint, aws_access_key_id = "test", aws_secret_access_key = "test", region_name = "us-east-1")
+    b = s3.Bucket(BUCKET)
+    b.create()
+    yield b
+    b.objects.all().delete()
+    b.delete()
+
+@pytest.fixture
+def index_db(tmp_path):
+    """Create an index with the given archive rows, returning its path."""
+    import sqlite_utils
+    def create(rows):
+        path = str(tmp_path / "index.db")
+        db = sqlite_utils.Database(path)
+        db["archive"].create({"uuid": str, "file_name": str, "file_timestamp": int, "file_date": str, "file_duplicate": int, "file_md5": str, "file_size": int})
+        db["archive"].insert_all(rows)
+        db.conn.close()
+        return path
+    return create
+
+def write_changeset(path, entries):
+    with gzip.open(path, "wt") as changeset:
+        for e in entries:
+            changeset.write(json.dumps(e) + "\n")
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        host = self.headers["Host"].split(":")[0]
+        with server.lock:
+            server.active[host] = server.active.get(host, 0) + 1
+            server.max_active[host] = max(server.max_active.get(host, 0), server.active[host])
+            server.max_total = max(server.max_total, sum(server.active.values()))
+        try:
+            time.sleep(0.2)
+            if self.path.startswith("/fail"):
+                self.send_response(500)
+                self.end_headers()
+            else:
+                body = server.files.get(self.path, b"date,cases\n2021-01-01,1\n")
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active[host] -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.lock = threading.Lock()
+    httpd.active = {}
+    httpd.max_active = {}
+    httpd.max_total = 0
+    # response bodies by path (other paths return a small CSV file, paths beginning with /fail return an error)
+    httpd.files = {}
+    thread = threading.Thread(target = httpd.serve_forever, daemon = True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.fixture
+def archivist(request):
+    """Run python -m archivist with the given arguments, using the local S3 server if the test uses the bucket fixture.
+
+    If code is given, it is run instead of __main__, with the arguments in sys.argv (archivist parses them when first imported).
+    """
+    def run(*args, code = None):
+        # S3 requests of tests without a bucket go to a closed port rather than AWS
+        endpoint = request.getfixturevalue("s3_endpoint") if "bucket" in request.fixturenames else "http://127.0.0.1:9"
+        env = dict(os.environ,
+            AWS_ID = "test", AWS_KEY = "test",
+            S3_BUCKET = BUCKET, S3_ROOT = ROOT, S3_URL = endpoint + "/" + BUCKET + "/",
+            AWS_ENDPOINT_URL = endpoint, AWS_DEFAULT_REGION = "us-east-1", AWS_MAX_ATTEMPTS = "1")
+        if code is None:
+            cmd = [sys.executable, "-m", "archivist"] + list(args)
+        else:
+            cmd = [sys.executable, "-c", "import sys; sys.argv = " + repr(["archivist"] + list(args)) + "\n" + code]
+        p = subprocess.run(cmd, env = env, capture_output = True, text = True, timeout = 300)
+        # show output of failed runs
+        print(p.stdout)
+        print(p.stderr, file = sys.stderr)
+        return p
+    return run
@@ -0,0 +1,91 @@
+import json
+
+from archivist.utils.catalog import CATALOG_VERSION, normalize_dataset, compile_catalog, load_catalog
+
+def dataset(uuid = "uuid", **kwargs):
+    d = {
+        "uuid": uuid,
+        "file_name": "cases",
+        "dir_parent": "can",
+        "dir_file": "cases",
+        "file_ext": "csv",
+        "url": "https://example.com/cases.csv",
+        "dl_fun": "dl_file",
+        "args": {}
+        }
+    d.update(kwargs)
+    return d
+
+def test_normalize_dataset():
+    warnings = []
+    info = normalize_dataset(dataset(args = {"verify": "False", "min_size": "1 KB", "wait": "5", "compress": "gzip", "unknown": "x"}), warnings)
+    assert info["file_path"] == "can/cases/cases"
+    assert info["file_ext"] == ".csv"
+    assert info["args"] == {"verify": False, "min_size": 1000, "wait": 5, "compress": "gzip"}
+    assert warnings == []
+
+def test_normalize_dataset_invalid_args():
+    warnings = []
+    info = normalize_dataset(dataset(args = {"verify": "yes", "wait": "five"}), warnings)
+    assert info["args"] == {"verify": False, "wait": 0}
+    assert len(warnings) == 2
+
+def test_normalize_dataset_html_page():
+    # html_page without js is downloaded using dl_file
+    assert normalize_dataset(dataset(dl_fun = "html_page"), [])["dl_fun"] == "dl_file"
+    info = normalize_dataset(dataset(dl_fun = "html_page", args = {"js": "False"}), [])
+    assert info["dl_fun"] == "dl_file"
+    assert "js" not in info["args"]
+    info = normalize_dataset(dataset(dl_fun = "html_page", args = {"js": "True", "verify": "False"}), [])
+    assert info["dl_fun"] == "html_page"
+    assert "verify" not in info["args"]
+
+def test_normalize_dataset_no_url():
+    warnings = []
+    d = dataset()
+    d.pop("url")
+    normalize_dataset(d, warnings)
+    assert len(warnings) == 1
+
+def write_datasets(path, ds):
+    with open(path, "w") as f:
+        json.dump(ds, f)
+    return str(path)
+
+def test_compile_catalog(tmp_path):
+    missing = dataset("c")
+    missing.pop("dl_fun")
+    ds_path = write_datasets(tmp_path / "datasets.json", {
+        "active": {"can": [dataset("a"), missing]},
+        "inactive": {"can": [dataset("b")]}
+        })
+    catalog = compile_catalog(ds_path, str(tmp_path / ".datasets_catalog"))
+    assert catalog["version"] == CATALOG_VERSION
+    assert list(catalog["ds"]) == ["a", "c", "b"]
+    assert catalog["active"] == ["a", "c"]
+    assert set(catalog["info"]) == {"a", "b"}
+    assert list(catalog["warnings"]) == ["c"]
+
+def test_compile_catalog_duplicate_uuid(tmp_path):
+    # the last entry is used
+    ds_path = write_datasets(tmp_path / "datasets.json", {
+        "active": {"can": [dataset("a", file_name = "first")]},
+        "inactive": {"can": [dataset("a", file_name = "second")]}
+        })
+    catalog = compile_catalog(ds_path, str(tmp_path / ".datasets_catalog"))
+    assert catalog["ds"]["a"]["file_name"] == "second"
+    assert catalog["info"]["a"]["file_name"] == "second"
+    assert catalog["active"] == []
+    assert len(catalog["warnings"]["a"]) == 1
+
+def test_load_catalog(tmp_path):
+    ds_path = write_datasets(tmp_path / "datasets.json", {"active": {"can": [dataset("a")]}})
+    cache_path = str(tmp_path / ".datasets_catalog")
+    catalog, recompiled = load_catalog(ds_path, cache_path)
+    assert recompiled
+    assert load_catalog(ds_path, cache_path) == (catalog, False)
+    # changes to datasets.json are picked up
+    write_datasets(ds_path, {"active": {"can": [dataset("a"), dataset("b")]}})
+    catalog, recompiled = load_catalog(ds_path, cache_path)
+    assert recompiled
+    assert catalog["active"] == ["a", "b"]
@@ -0,0 +1,57 @@
+import threading
+import pytest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from archivist.utils.http import new_session, session_stats
+
+class CookieHandler(BaseHTTPRequestHandler):
+    # keep connections open, as most servers do
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/login":
+            # set a cookie and redirect
+            self.send_response(302)
+            self.send_header("Set-Cookie", "session=abc; Path=/")
+            self.send_header("Location", "/cookie")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = (self.headers.get("Cookie") or "").encode("utf-8")
+        self.send_response(200)
+        if self.path == "/set":
+            self.send_header("Set-Cookie", "session=abc; Path=/")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def url():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), CookieHandler)
+    threading.Thread(target = httpd.serve_forever, daemon = True).start()
+    yield "http://127.0.0.1:" + str(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.mark.parametrize("legacy_ssl", [False, True])
+def test_session_keeps_no_cookies(url, legacy_ssl):
+    session = new_session(legacy_ssl = legacy_ssl)
+    assert session.get(url + "/set").text == ""
+    # cookies set for one dataset are not sent with the next request
+    assert session.get(url + "/cookie").text == ""
+    assert len(session.cookies) == 0
+
+def test_session_redirect_cookies(url):
+    # cookies set during redirects are sent with the same request, as with requests.get()
+    session = new_session()
+    assert session.get(url + "/login").text == "session=abc"
+    assert session.get(url + "/cookie").text == ""
+
+def test_session_reuses_connections(url):
+    session = new_session()
+    for _ in range(3):
+        session.get(url + "/cookie")
+    assert session_stats(session) == (3, 1)
@@ -0,0 +1,56 @@
+import re
+
+from archivist.utils.indexing import parse_file_timestamp, timestamp_to_epoch, index_rows, mark_duplicates, changeset_name, pending_changesets, folded_changesets
+
+def row(f_name, f_timestamp, f_md5, f_size = 1):
+    return {"file_name": f_name, "file_timestamp": f_timestamp, "file_md5": f_md5, "file_size": f_size, "file_duplicate": None}
+
+def test_mark_duplicates():
+    rows = mark_duplicates([
+        row("c", 3, "a"),
+        row("a", 1, "a"),
+        row("b", 2, "b"),
+        row("d", 4, "a", 2), # same hash, different size
+        row("e", 5, "b")
+        ])
+    assert [r["file_name"] for r in rows] == ["a", "b", "c", "d", "e"]
+    assert [r["file_duplicate"] for r in rows] == [0, 0, 1, 0, 1]
+
+def test_mark_duplicates_same_timestamp():
+    # ties are broken by file name, so the result does not depend on the order of the rows
+    rows = mark_duplicates([row("b", 1, "a"), row("a", 1, "a")])
+    assert [(r["file_name"], r["file_duplicate"]) for r in rows] == [("a", 0), ("b", 1)]
+
+def test_parse_file_timestamp():
+    assert parse_file_timestamp("cases_2021-01-31_12-00.csv") == ("2021-01-31_12-00", "2021-01-31")
+    assert parse_file_timestamp("cases_daily_2021-01-31_12-00.tar.gz") == ("2021-01-31_12-00", "2021-01-31")
+
+def test_timestamp_to_epoch():
+    assert timestamp_to_epoch("1970-01-01_00-01", "UTC") == 60
+    assert timestamp_to_epoch("2021-01-31_12-00", "America/Toronto") == timestamp_to_epoch("2021-01-31_17-00", "UTC")
+
+def test_index_rows():
+    rows = index_rows("uuid", [("f_2021-01-02_00-00.csv", 2, "a"), ("f_2021-01-01_00-00.csv", 2, "a")], "UTC")
+    assert [(r["file_date"], r["file_duplicate"]) for r in rows] == [("2021-01-01", 0), ("2021-01-02", 1)]
+
+def test_changeset_name():
+    assert re.fullmatch(r"\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}_[0-9a-f]{8}\.jsonl\.gz", changeset_name())
+    # names sort in order of runs
+    assert changeset_name(0) < changeset_name(1) < changeset_name(86400)
+    assert changeset_name(0) != changeset_name(0)
+
+def test_pending_changesets():
+    keys = ["root/index_changes/" + changeset_name(t) for t in [30, 10, 20]]
+    pending = pending_changesets(keys, set())
+    assert pending == sorted(keys)
+    # applying changesets again skips those already applied
+    applied = set(k.split("/")[-1] for k in pending[:2])
+    assert pending_changesets(keys, applied) == pending[2:]
+    assert pending_changesets(keys, set(k.split("/")[-1] for k in keys)) == []
+
+def test_folded_changesets():
+    keys = ["root/index_changes/" + changeset_name(t) for t in [10, 20]]
+    applied = set([keys[0].split("/")[-1]])
+    assert folded_changesets(keys, applied) == keys[:1]
+    # changesets uploaded after the index was compacted are kept
+    assert folded_changesets(keys + ["root/index_changes/" + changeset_name(30)], applied) == keys[:1]
@@ -0,0 +1,137 @@
+import os
+import json
+import fcntl
+import hashlib
+import sqlite3
+
+from archivist.utils.indexing import changeset_name
+from conftest import ROOT, dataset, archive_row, write_changeset
+
+# run modes through python -m archivist (see conftest.py)
+
+def test_compact_index(project, bucket, index_db, archivist, tmp_path):
+    bucket.upload_file(Filename = index_db([archive_row("cases_2021-01-01_12-00.csv", 1609520400, "a" * 32, 10)]), Key = ROOT + "/index.db")
+    c_name = changeset_name()
+    write_changeset(str(tmp_path / c_name), [{"table": "archive", "row": archive_row("cases_2021-01-02_12-00.csv", 1609606800, "b" * 32, 10)}])
+    bucket.upload_file(Filename = str(tmp_path / c_name), Key = ROOT + "/index_changes/" + c_name)
+    p = archivist("compact_index", project)
+    assert p.returncode == 0
+    # changeset is folded into the snapshot and deleted
+    assert list(bucket.objects.filter(Prefix = ROOT + "/index_changes/")) == []
+    bucket.download_file(Filename = str(tmp_path / "compacted.db"), Key = ROOT + "/index.db")
+    db = sqlite3.connect(str(tmp_path / "compacted.db"))
+    assert [r[0] for r in db.execute("SELECT file_name FROM archive ORDER BY file_timestamp")] == ["cases_2021-01-01_12-00.csv", "cases_2021-01-02_12-00.csv"]
+    assert [r[0] for r in db.execute("SELECT name FROM index_changesets")] == [c_name]
+    db.close()
+
+def upload_archive(bucket, index_db, files):
+    # upload files of the dataset in conftest.py and an index of them
+    rows = []
+    for i, (f_name, content) in enumerate(files):
+        bucket.put_object(Key = ROOT + "/can/cases/" + f_name, Body = content)
+        rows.append(archive_row(f_name, 1609520400 + i * 86400, hashlib.md5(content).hexdigest(), len(content)))
+    bucket.upload_file(Filename = index_db(rows), Key = ROOT + "/index.db")
+
+def test_fetch(project, bucket, index_db, archivist, tmp_path):
+    upload_archive(bucket, index_db, [("cases_2021-01-01_12-00.csv", b"date,cases\n2021-01-01,1\n")])
+    out_path = str(tmp_path / "out.csv")
+    p = archivist("fetch", "cases_2021-01-01_12-00.csv", project, "-o", out_path)
+    assert p.returncode == 0
+    with open(out_path, "rb") as f:
+        assert f.read() == b"date,cases\n2021-01-01,1\n"
+
+def test_fetch_during_run(project, bucket, index_db, archivist, tmp_path):
+    # while another run holds the index cache, fetch uses a private copy of the index and deletes it afterwards
+    upload_archive(bucket, index_db, [("cases_2021-01-01_12-00.csv", b"date,cases\n2021-01-01,1\n")])
+    os.makedirs(os.path.join(project, ".index_cache"))
+    with open(os.path.join(project, ".index_cache", "index.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        p = archivist("fetch", "cases_2021-01-01_12-00.csv", project, "-o", str(tmp_path / "out.csv"))
+    assert p.returncode == 0
+    assert "private copy" in p.stdout
+    assert os.path.exists(tmp_path / "out.csv")
+    assert [d for d in os.listdir(project) if d.startswith("index_")] == []
+
+def test_stitch_log(project, bucket, archivist, tmp_path):
+    bucket.put_object(Key = ROOT + "/log.txt", Body = b"full log")
+    bucket.put_object(Key = ROOT + "/logs/2021/01/02/2021-01-02_12-00-00.txt", Body = b"run 2")
+    bucket.put_object(Key = ROOT + "/logs/2021/01/01/2021-01-01_12-00-00.txt", Body = b"run 1")
+    p = archivist("stitch_log", project, "-o", str(tmp_path / "log.txt"))
+    assert p.returncode == 0
+    with open(tmp_path / "log.txt") as f:
+        assert f.read() == "full log\n\nrun 1\n\nrun 2"
+    p = archivist("stitch_log", project, "-o", str(tmp_path / "log.txt"), "--since", "2021-01-02")
+    assert p.returncode == 0
+    with open(tmp_path / "log.txt") as f:
+        assert f.read() == "run 2"
+
+def test_compile_catalog(project, archivist):
+    p = archivist("compile_catalog", project)
+    assert p.returncode == 0
+    assert "Compiled 1 datasets (1 active)" in p.stdout
+    assert os.path.exists(os.path.join(project, ".datasets_catalog"))
+
+def write_mirror(archive_dir, files):
+    # write files of the dataset in conftest.py to a local mirror of the bucket
+    path_dir = os.path.join(archive_dir, "can", "cases")
+    os.makedirs(path_dir, exist_ok = True)
+    for f_name, content in files:
+        with open(os.path.join(path_dir, f_name), "wb") as f:
+            f.write(content)
+
+def read_archive(path):
+    db = sqlite3.connect(path)
+    rows = [r for r in db.execute("SELECT file_name, file_duplicate, file_md5, file_size FROM archive ORDER BY file_timestamp")]
+    db.close()
+    return rows
+
+def test_initialize_index(project, archivist, tmp_path):
+    archive_dir = str(tmp_path / "archive")
+    files = [("cases_2021-01-01_12-00.csv", b"a\n"), ("cases_2021-01-02_12-00.csv", b"a\n"), ("cases_2021-01-03_12-00.csv", b"b\n")]
+    write_mirror(archive_dir, files)
+    p = archivist("initialize_index", archive_dir, project, "--workers", "2")
+    assert p.returncode == 0
+    assert read_archive(os.path.join(archive_dir, "index.db")) == [
+        (f_name, duplicate, hashlib.md5(content).hexdigest(), len(content)) for (f_name, content), duplicate in zip(files, [0, 1, 0])]
+    # only new files are hashed
+    write_mirror(archive_dir, [("cases_2021-01-04_12-00.csv", b"c\n")])
+    p = archivist("initialize_index", archive_dir, project, "--incremental")
+    assert p.returncode == 0
+    assert "Hashing 1 files" in p.stdout
+    assert [r[0] for r in read_archive(os.path.join(archive_dir, "index.db"))] == [f[0] for f in files] + ["cases_2021-01-04_12-00.csv"]
+
+def test_initialize_index_from_s3(project, bucket, archivist, tmp_path):
+    files = [("cases_2021-01-01_12-00.csv", b"a\n"), ("cases_2021-01-02_12-00.csv", b"a\n")]
+    for f_name, content in files:
+        bucket.put_object(Key = ROOT + "/can/cases/" + f_name, Body = content)
+    out_path = str(tmp_path / "index.db")
+    p = archivist("initialize_index", str(tmp_path), project, "--from-s3", "-o", out_path)
+    assert p.returncode == 0
+    assert read_archive(out_path) == [(f_name, duplicate, hashlib.md5(content).hexdigest(), len(content)) for (f_name, content), duplicate in zip(files, [0, 1])]
+
+def test_prod_compress(project, bucket, index_db, server, archivist):
+    # files are stored compressed only if they become smaller
+    port = str(server.server_address[1])
+    large = b"date,cases\n" + b"2021-01-01,1\n" * 1000
+    server.files["/large.csv"] = large
+    with open(os.path.join(project, "datasets.json"), "w") as ds_file:
+        json.dump({"active": {"can": [
+            dataset("small000-0000-0000-0000-000000000000", url = "http://127.0.0.1:" + port + "/small.csv", dir_file = "small", file_name = "small"),
+            dataset("large000-0000-0000-0000-000000000000", url = "http://127.0.0.1:" + port + "/large.csv", dir_file = "large", file_name = "large")
+            ]}, "inactive": {"can": []}}, ds_file)
+    with open(os.path.join(project, "config.toml")) as f:
+        config = f.read()
+    with open(os.path.join(project, "config.toml"), "w") as f:
+        f.write(config.replace('compress = "none"', 'compress = "gzip"'))
+    bucket.upload_file(Filename = index_db([]), Key = ROOT + "/index.db")
+    p = archivist("prod", project)
+    assert p.returncode == 0
+    assert "Successful downloads: 2/2" in p.stdout
+    client = bucket.meta.client
+    small = client.head_object(Bucket = bucket.name, Key = next(iter(bucket.objects.filter(Prefix = ROOT + "/can/small/"))).key)
+    assert "ContentEncoding" not in small
+    assert small["ContentLength"] == len(b"date,cases\n2021-01-01,1\n")
+    large_head = client.head_object(Bucket = bucket.name, Key = next(iter(bucket.objects.filter(Prefix = ROOT + "/can/large/"))).key)
+    assert large_head["ContentEncoding"] == "gzip"
+    assert large_head["ContentLength"] < len(large)
+    assert large_head["Metadata"] == {"md5": hashlib.md5(large).hexdigest(), "size": str(len(large))}
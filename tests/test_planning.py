@@ -0,0 +1,56 @@
+import math
+import pytest
+
+from archivist.utils.planning import estimate_duration, order_by_history, count_changes, change_probability
+
+def history(duration, failure_rate = 0, host = None):
+    return {"duration": duration, "failure_rate": failure_rate, "host": host, "runs": 10}
+
+def test_estimate_duration():
+    assert estimate_duration([], 4) == 0
+    assert estimate_duration([1, 2, 3]) == 6
+    assert estimate_duration([1, 2, 3], 3) == 3
+    assert estimate_duration([4, 1, 1, 1, 1], 2) == 4
+    # datasets are started in order: a slow dataset at the end runs alone
+    assert estimate_duration([1, 1, 1, 1, 4], 2) == 6
+
+def test_order_by_history_longest_first():
+    h = {"a": history(1), "b": history(5), "c": history(3)}
+    assert order_by_history(["a", "b", "c"], h) == ["b", "c", "a"]
+    assert estimate_duration([5, 3, 1], 2) <= estimate_duration([1, 3, 5], 2)
+
+def test_order_by_history_failure_rate():
+    h = {"a": history(4), "b": history(3, failure_rate = 0.5)}
+    assert order_by_history(["a", "b"], h) == ["b", "a"]
+
+def test_order_by_history_without_history():
+    # datasets without history are given the median duration
+    h = {"a": history(1), "b": history(2), "c": history(10)}
+    assert order_by_history(["a", "b", "c", "d"], h) == ["c", "b", "d", "a"]
+    assert order_by_history(["x", "y"], {}) == ["x", "y"]
+
+def test_order_by_history_spreads_hosts():
+    h = {"a": history(10, host = "h1"), "b": history(9, host = "h1"), "c": history(8, host = "h2")}
+    assert order_by_history(["a", "b", "c"], h, workers = 1) == ["a", "b", "c"]
+    assert order_by_history(["a", "b", "c"], h, workers = 2) == ["a", "c", "b"]
+    # hosts of datasets without history are given separately
+    h = {"a": history(10, host = "h1"), "b": history(9, host = "h1"), "c": history(8, host = "h1")}
+    assert order_by_history(["a", "b", "c", "d"], h, workers = 2, hosts = {"d": "h2"}) == ["a", "d", "b", "c"]
+
+def test_count_changes():
+    assert count_changes([]) == 0
+    assert count_changes([(0, "a")]) == 0
+    assert count_changes([(0, "a"), (1, "a"), (2, "b"), (3, "b")]) == 1
+    # reverting to an earlier version is a change
+    assert count_changes([(0, "a"), (1, "b"), (2, "a")]) == 2
+
+def test_change_probability():
+    hour = 3600
+    # no changes in 100 hours: rate of 1 change per 100 hours
+    snapshots = [(i * hour, "a") for i in range(101)]
+    assert change_probability(snapshots, 100 * hour) == 0
+    assert change_probability(snapshots, 101 * hour) == pytest.approx(1 - math.exp(-1 / 100))
+    # more changes make a change more likely
+    changed = [(i * hour, "a" if i % 2 == 0 else "b") for i in range(101)]
+    assert change_probability(changed, 101 * hour) > change_probability(snapshots, 101 * hour)
+    assert change_probability(snapshots, 200 * hour) > change_probability(snapshots, 101 * hour)
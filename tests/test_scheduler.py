@@ -0,0 +1,40 @@
+import json
+
+from conftest import dataset
+
+# run the download scheduler through python -m archivist (test mode, which downloads without uploading)
+
+def write_datasets(project, ds):
+    with open(project + "/datasets.json", "w") as ds_file:
+        json.dump({"active": {"can": ds}, "inactive": {"can": []}}, ds_file)
+
+def test_max_per_host(project, server, archivist):
+    # max_per_host is 2 in the sample config.toml
+    port = server.server_address[1]
+    ds = [dataset("%08d-0000-0000-0000-000000000000" % i, url = "http://" + host + ":" + str(port) + "/" + str(i), file_name = "f" + str(i))
+          for i, host in enumerate(["127.0.0.1", "localhost"] * 6)]
+    write_datasets(project, ds)
+    p = archivist("test", project, "--workers", "8")
+    assert p.returncode == 0
+    assert "Successful downloads: 12/12" in p.stdout
+    assert server.max_active == {"127.0.0.1": 2, "localhost": 2}
+    assert server.max_total > 2
+
+def test_failure_does_not_stop_pool(project, server, archivist):
+    port = server.server_address[1]
+    ds = [dataset("%08d-0000-0000-0000-000000000000" % i, url = "http://127.0.0.1:" + str(port) + "/" + str(i), file_name = "f" + str(i)) for i in range(4)]
+    # a download that fails and an entry that cannot be downloaded at all
+    ds.insert(1, dataset("fail0000-0000-0000-0000-000000000000", url = "http://127.0.0.1:" + str(port) + "/fail"))
+    invalid = dataset("invalid0-0000-0000-0000-000000000000")
+    invalid.pop("dl_fun")
+    ds.insert(0, invalid)
+    write_datasets(project, ds)
+    p = archivist("test", project, "--workers", "3")
+    assert p.returncode == 0
+    assert "Successful downloads: 4/6" in p.stdout
+    assert "Failed downloads: 2/6" in p.stdout
+    # failed datasets can be rerun
+    rerun = [line for line in p.stderr.splitlines() if line.startswith("RERUN:")]
+    assert len(rerun) == 1
+    assert "fail0000-0000-0000-0000-000000000000" in rerun[0]
+    assert "invalid0-0000-0000-0000-000000000000" in rerun[0]
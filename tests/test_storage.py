@@ -0,0 +1,63 @@
+import json
+import pytest
+
+from archivist.utils.storage import DELTA_FORMAT, make_delta, apply_delta, compress_file, decompress_file, decompress_bytes
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+def round_trip(tmp_path, base, new, max_size = None):
+    delta = make_delta(write(tmp_path / "base", base), write(tmp_path / "new", new), max_size)
+    if delta is not None:
+        assert apply_delta(base, delta) == new
+    return delta
+
+@pytest.mark.parametrize("base, new", [
+    (b"a\nb\nc\n", b"a\nb\nc\n"),
+    (b"a\nb\nc\n", b"a\nx\nc\nd\n"),
+    (b"a\nb\nc\n", b"c\nb\na\n"),
+    (b"", b"a\nb\n"),
+    (b"a\nb\n", b""),
+    (b"a\nb", b"a\nb\nc"), # no trailing newline
+    (b"a\r\nb\r\n", b"a\r\nc\r\n"), # line endings are kept
+    (b"a\rb\n", b"a\rc\n"), # "\r" alone does not end a line
+    (bytes(range(256)) + b"\n", bytes(range(255, -1, -1)) + b"\n") # any bytes
+    ])
+def test_delta_round_trip(tmp_path, base, new):
+    assert round_trip(tmp_path, base, new) is not None
+
+def test_delta_repetitive_lines(tmp_path):
+    # copies resume after the last copy rather than at the first matching line
+    base = b"".join(b"row,%d\nsep\n" % i for i in range(1000))
+    new = base.replace(b"row,500\n", b"row,500,changed\n")
+    delta = round_trip(tmp_path, base, new)
+    assert len(delta) < 200
+
+def test_delta_ops(tmp_path):
+    delta = json.loads(round_trip(tmp_path, b"a\nb\nc\n", b"a\nb\nx\n"))
+    assert delta["format"] == DELTA_FORMAT
+    assert delta["ops"] == [[0, 2], "x\n"]
+
+def test_delta_max_size(tmp_path):
+    assert round_trip(tmp_path, b"a\n", b"a\n" + b"x" * 100 + b"\n", max_size = 50) is None
+    assert round_trip(tmp_path, b"a\n", b"a\n" + b"x" * 10 + b"\n", max_size = 50) is not None
+
+def test_apply_delta_unknown_format():
+    with pytest.raises(Exception):
+        apply_delta(b"", json.dumps({"format": "unknown", "ops": []}).encode("utf-8"))
+
+def test_compress_round_trip(tmp_path):
+    data = b"date,value\n" * 1000
+    in_path = write(tmp_path / "data.csv", data)
+    compress_file(in_path, str(tmp_path / "data.csv.gz"), "gzip")
+    decompress_file(str(tmp_path / "data.csv.gz"), str(tmp_path / "out.csv"), "gzip")
+    with open(tmp_path / "out.csv", "rb") as f:
+        assert f.read() == data
+    with open(tmp_path / "data.csv.gz", "rb") as f:
+        assert decompress_bytes(f.read(), "gzip") == data
+
+def test_compress_unknown_encoding(tmp_path):
+    with pytest.raises(Exception):
+        compress_file(write(tmp_path / "data.csv", b""), str(tmp_path / "out"), "bz2")
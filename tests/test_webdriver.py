@@ -0,0 +1,40 @@
+# the pool is tested with a stand-in for Webdriver, as the tests do not start Chrome
+
+BORROW = """
+import tempfile
+import archivist.classes.Webdriver as W
+events = []
+class FakeWebdriver:
+    def __init__(self):
+        self.uses = 0
+        events.append("start")
+    def reset(self, tmpdir):
+        if FAIL_RESET:
+            raise Exception("reset failed")
+    def alive(self):
+        return True
+    def quit(self):
+        events.append("quit")
+W.Webdriver = FakeWebdriver
+pool = W.WebdriverPool
+tmpdir = tempfile.TemporaryDirectory()
+try:
+    with pool.borrow(tmpdir) as driver:
+        pass
+    with pool.borrow(tmpdir) as driver:
+        pass
+except Exception as e:
+    events.append(str(e))
+pool.close()
+print(events)
+"""
+
+def test_borrow_reuses_browser(project, archivist):
+    p = archivist("test", project, code = "FAIL_RESET = False\n" + BORROW)
+    assert p.returncode == 0
+    assert p.stdout.splitlines()[-1] == "['start', 'quit']"
+
+def test_borrow_quits_browser_that_fails_to_reset(project, archivist):
+    p = archivist("test", project, code = "FAIL_RESET = True\n" + BORROW)
+    assert p.returncode == 0
+    assert p.stdout.splitlines()[-1] == "['start', 'quit', 'reset failed']"
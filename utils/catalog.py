@@ -0,0 +1,159 @@
+# import modules
+import os
+import hashlib
+import json
+import pickle
+from humanfriendly import parse_size
+
+# version of the catalog cache format (increment when normalize_dataset() or compile_catalog() changes)
+CATALOG_VERSION = 3
+
+# typed dataset args
+BOOL_ARGS = [
+    "user", "rand_url", "verify",
+    "legacy_ssl", "unzip", "js",
+    "wait_fixed", "delta"
+    ]
+INT_ARGS = [
+    "wait", "min_size", "width", "height",
+    "max_staleness"
+    ]
+STR_ARGS = [
+    "ready_css", "compress"
+    ]
+
+# define functions
+def arg_bool(k, v, warnings):
+    try:
+        if v == "True":
+            return True
+        elif v == "False":
+            return False
+        else:
+            raise ValueError
+    except:
+        warnings.append("Error interpreting arg " + k + ", setting value to False.")
+        return False
+
+def arg_int(k, v, warnings):
+    try:
+        if k == "min_size":
+            return parse_size(v)
+        else:
+            return(int(v))
+    except:
+        warnings.append("Error interpreting arg " + k + ", setting value to 0.")
+        return 0
+
+def normalize_dataset(d, warnings):
+    """Convert a dataset from datasets.json to the static part of the information used by Downloader.
+
+    The URL is not included, as it may be resolved at run time (url_fun_python).
+
+    Parameters:
+    d (dict): Dataset from datasets.json.
+    warnings (list): Problems with the dataset are appended to this list.
+
+    Returns:
+    dict: File name, path and extension, typed args and download function.
+    """
+    info = {}
+    # get file name, path and extension
+    info["file_name"] = d["file_name"]
+    info["file_path"] = os.path.join(d["dir_parent"], d["dir_file"], info["file_name"])
+    info["file_ext"] = "." + d["file_ext"]
+    # process args
+    info["args"] = {}
+    for k, v in d["args"].items():
+        if k in BOOL_ARGS:
+            info["args"][k] = arg_bool(k, v, warnings)
+        elif k in INT_ARGS:
+            info["args"][k] = arg_int(k, v, warnings)
+        elif k in STR_ARGS:
+            info["args"][k] = v
+    # download function
+    info["dl_fun"] = d["dl_fun"]
+    # use dl_file instead of html_page for simple HTML pages (pages not requiring JS)
+    if info["dl_fun"] == "html_page":
+        if "js" in info["args"]:
+            if info["args"]["js"] is False:
+                info["dl_fun"] = "dl_file"
+                info["args"].pop("js", None) # dl_file will not accept this arg
+        else:
+            info["dl_fun"] = "dl_file"
+    # filter out unwanted keywords
+    if info["dl_fun"] == "html_page":
+        info["args"].pop("verify", None) # html_page will not accept this arg
+    # check URL
+    if "url" not in d and "url_fun_python" not in d:
+        warnings.append("Neither a URL nor a URL function are given.")
+    return info
+
+def hash_catalog(ds_path):
+    with open(ds_path, "rb") as ds_file:
+        return hashlib.md5(ds_file.read()).hexdigest()
+
+def compile_catalog(ds_path, cache_path, ds_hash = None):
+    """Validate datasets.json and write the catalog cache.
+
+    Parameters:
+    ds_path (str): Path to datasets.json.
+    cache_path (str): Path to the catalog cache.
+    ds_hash (str): Optional. MD5 hash of datasets.json, if already calculated.
+
+    Returns:
+    dict: The catalog: datasets keyed by UUID ("ds"), UUIDs of active datasets ("active"),
+    normalized dataset information keyed by UUID ("info") and problems found keyed by UUID ("warnings").
+    If a UUID appears more than once, the last entry is used, as when datasets.json was loaded directly.
+    """
+    if ds_hash is None:
+        ds_hash = hash_catalog(ds_path)
+    with open(ds_path) as json_file:
+        ds_raw = json.load(json_file)
+    catalog = {"version": CATALOG_VERSION, "hash": ds_hash, "ds": {}, "active": [], "info": {}, "warnings": {}}
+    # flatten datasets to a single dictionary
+    for status in ds_raw:
+        for group in ds_raw[status].values():
+            for d in group:
+                uuid = d["uuid"]
+                warnings = []
+                if uuid in catalog["ds"]:
+                    # the later entry replaces the earlier one
+                    warnings.append("Duplicate UUID, using later entry.")
+                    if uuid in catalog["active"]:
+                        catalog["active"].remove(uuid)
+                    catalog["info"].pop(uuid, None)
+                    catalog["warnings"].pop(uuid, None)
+                catalog["ds"][uuid] = d
+                if status == "active":
+                    catalog["active"].append(uuid)
+                try:
+                    catalog["info"][uuid] = normalize_dataset(d, warnings)
+                except KeyError as e:
+                    warnings.append("Missing field: " + str(e))
+                if len(warnings) > 0:
+                    catalog["warnings"][uuid] = warnings
+    # write cache (replace atomically, as other runs may be reading it)
+    tmp_path = cache_path + "." + str(os.getpid())
+    with open(tmp_path, "wb") as cache_file:
+        pickle.dump(catalog, cache_file, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+    return catalog
+
+def load_catalog(ds_path, cache_path):
+    """Load the catalog cache, recompiling it if datasets.json has changed (see compile_catalog()).
+
+    Returns:
+    tuple: The catalog and whether it was recompiled.
+    """
+    ds_hash = hash_catalog(ds_path)
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as cache_file:
+                catalog = pickle.load(cache_file)
+            if catalog.get("version") == CATALOG_VERSION and catalog.get("hash") == ds_hash:
+                return catalog, False
+        except Exception:
+            # unreadable cache; recompile
+            pass
+    return compile_catalog(ds_path, cache_path, ds_hash), True
@@ -8,7 +8,8 @@ from archivist.classes.Archivist import Archivist as a
 # define functions
 def get_datetime(ignore_fake_datetime = False):
     tz = a.config["project"]["tz"]
-    if a.options["fake_datetime"] and not ignore_fake_datetime:
+    # only prod and test runs have a fake_datetime option
+    if not ignore_fake_datetime and a.options.get("fake_datetime"):
         t = a.options["fake_datetime"]
     else:
         t = datetime.now(pytz.timezone(tz))
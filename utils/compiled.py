@@ -0,0 +1,30 @@
+# import modules
+import hashlib
+import threading
+
+# compiled code objects, keyed by MD5 hash of the source code
+_cache = {}
+_lock = threading.Lock()
+
+# define functions
+def compile_cached(source, filename):
+    """Compile Python source code, reusing the code object if the same source was already compiled in this run.
+
+    Parameters:
+    source (str): Source code.
+    filename (str): Name shown in tracebacks.
+
+    Returns:
+    code: Code object, to be run using exec().
+
+    Raises:
+    SyntaxError: If the source code is invalid.
+    """
+    key = hashlib.md5(source.encode("utf-8")).hexdigest()
+    with _lock:
+        code = _cache.get(key)
+    if code is None:
+        code = compile(source, filename, "exec")
+        with _lock:
+            _cache[key] = code
+    return code
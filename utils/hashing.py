@@ -0,0 +1,58 @@
+# import modules
+import hashlib
+
+# size of chunks used when reading and writing files
+CHUNK_SIZE = 1024 * 1024 # 1 MiB
+
+# define functions
+def md5_file(f_path, chunk_size = CHUNK_SIZE):
+    """Calculate the MD5 hash and size of a file without reading it into memory all at once.
+
+    Parameters:
+    f_path (str): Path to the file.
+    chunk_size (int): Optional. Number of bytes to read at a time. Defaults to 1 MiB.
+
+    Returns:
+    tuple: MD5 hash (hex digest) and size of the file in bytes.
+    """
+    f_md5 = hashlib.md5()
+    f_size = 0
+    with open(f_path, "rb") as f_data:
+        for chunk in iter(lambda: f_data.read(chunk_size), b""):
+            f_md5.update(chunk)
+            f_size += len(chunk)
+    return f_md5.hexdigest(), f_size
+
+def md5_chunks(chunks):
+    """Calculate the MD5 hash and size of an iterable of byte chunks (e.g., a streamed response).
+
+    Returns:
+    tuple: MD5 hash (hex digest) and size in bytes.
+    """
+    f_md5 = hashlib.md5()
+    f_size = 0
+    for chunk in chunks:
+        f_md5.update(chunk)
+        f_size += len(chunk)
+    return f_md5.hexdigest(), f_size
+
+def write_chunks(chunks, f_path):
+    """Write an iterable of byte chunks (e.g., a streamed response) to a file, calculating the MD5 hash and size in the same pass.
+
+    Parameters:
+    chunks (iterable): Chunks of bytes to write.
+    f_path (str): Path to the output file.
+
+    Returns:
+    tuple: MD5 hash (hex digest) and size of the file in bytes.
+    """
+    f_md5 = hashlib.md5()
+    f_size = 0
+    with open(f_path, "wb") as local_file:
+        for chunk in chunks:
+            if not chunk:
+                continue
+            f_md5.update(chunk)
+            f_size += len(chunk)
+            local_file.write(chunk)
+    return f_md5.hexdigest(), f_size
@@ -0,0 +1,73 @@
+# import modules
+import ssl
+from http.cookiejar import CookiePolicy
+import requests
+import urllib3
+
+# define classes
+class LegacySSLAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter allowing unsafe legacy TLS renegotiation.
+
+    Workaround for unsafe_legacy_renegotiation error:
+    https://github.com/scrapy/scrapy/issues/5491#issuecomment-1241862323
+    """
+    def __init__(self, ssl_context=None, **kwargs):
+        self.ssl_context = ssl_context
+        super().__init__(**kwargs)
+    def init_poolmanager(self, connections, maxsize, block=False):
+        self.poolmanager = urllib3.poolmanager.PoolManager(
+            num_pools=connections, maxsize=maxsize,
+            block=block, ssl_context=self.ssl_context)
+
+class BlockAllCookies(CookiePolicy):
+    """Cookie policy that keeps no cookies between requests.
+
+    Sessions are shared by all datasets from the same host, so cookies set for one dataset would
+    otherwise be sent with the requests of other datasets. Cookies set during the redirects of a
+    single request are still sent with that request, as with requests.get().
+    """
+    return_ok = set_ok = domain_return_ok = path_return_ok = lambda self, *args, **kwargs: False
+    netscape = True
+    rfc2965 = hide_cookie2 = False
+
+# define functions
+def new_session(verify = True, legacy_ssl = False, pool_maxsize = 10):
+    """Create a keep-alive session for requests, which does not keep cookies (see BlockAllCookies).
+
+    Parameters:
+    verify (bool): Whether to verify SSL certificates. Ignored if legacy_ssl is True.
+    legacy_ssl (bool): Whether to allow unsafe legacy TLS renegotiation.
+    pool_maxsize (int): Maximum number of connections to keep open per host.
+    """
+    session = requests.Session()
+    session.cookies.set_policy(BlockAllCookies())
+    if legacy_ssl:
+        ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+        ctx.options |= 0x4  # OP_LEGACY_SERVER_CONNECT
+        session.mount("https://", LegacySSLAdapter(ctx, pool_connections=10, pool_maxsize=pool_maxsize))
+        session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=pool_maxsize))
+        # if verify is False, get the following error: "Cannot set verify_mode to CERT_NONE when check_hostname is enabled."
+        session.verify = True
+    else:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=pool_maxsize)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.verify = verify
+    return session
+
+def session_stats(session):
+    """Count requests made and connections opened by a session.
+
+    Returns:
+    tuple: Number of requests and number of new connections.
+    """
+    n_requests = 0
+    n_connections = 0
+    adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            n_requests += pool.num_requests
+            n_connections += pool.num_connections
+    return n_requests, n_connections
@@ -0,0 +1,106 @@
+# import modules
+import os
+import re
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+# import functions
+from archivist.utils.hashing import md5_file
+
+# regular expression for the timestamp in archived file names (e.g., name_2021-01-01_12-00.csv)
+TIMESTAMP_RE = re.compile(r'(?<=_)(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}).*$')
+
+# regular expression for S3 ETags that are plain MD5 hashes (ETags of multipart uploads end in -<number of parts>)
+MD5_RE = re.compile(r'[0-9a-f]{32}')
+
+# define functions
+def parse_file_timestamp(f_name):
+    """Extract the timestamp and date from the name of an archived file.
+
+    Returns:
+    tuple: Timestamp (YYYY-MM-DD_HH-MM) and date (YYYY-MM-DD).
+    """
+    f_timestamp = TIMESTAMP_RE.search(f_name).group(1)
+    return f_timestamp, f_timestamp[:10]
+
+def timestamp_to_epoch(f_timestamp, tz):
+    """Convert a timestamp (YYYY-MM-DD_HH-MM) in the given time zone to seconds since the epoch."""
+    t = datetime.strptime(f_timestamp, "%Y-%m-%d_%H-%M").replace(tzinfo=ZoneInfo(tz))
+    return int(t.timestamp())
+
+def hash_file(job):
+    """Hash a file in chunks (run in a worker process by Archivist.initialize_index).
+
+    Parameters:
+    job (tuple): UUID, file name and file path.
+
+    Returns:
+    tuple: UUID, file name, file size, MD5 hash, worker process ID and seconds spent hashing.
+    """
+    uuid, f_name, f_path = job
+    t0 = time.monotonic()
+    f_md5, f_size = md5_file(f_path)
+    return uuid, f_name, f_size, f_md5, os.getpid(), time.monotonic() - t0
+
+def index_rows(uuid, files, tz):
+    """Create index rows for the files of a dataset.
+
+    Files are sorted by timestamp and duplicates are marked (see mark_duplicates()).
+
+    Parameters:
+    uuid (str): UUID of the dataset.
+    files (list): Tuples of file name, file size and MD5 hash.
+    tz (str): Time zone of the timestamps in the file names.
+
+    Returns:
+    list: Index rows (dicts) for the archive table.
+    """
+    rows = []
+    for f_name, f_size, f_md5 in files:
+        f_timestamp, f_date = parse_file_timestamp(f_name)
+        rows.append({
+            "uuid": uuid,
+            "file_name": f_name,
+            "file_timestamp": timestamp_to_epoch(f_timestamp, tz),
+            "file_date": f_date,
+            "file_duplicate": None,
+            "file_md5": f_md5,
+            "file_size": f_size
+        })
+    return mark_duplicates(rows)
+
+def mark_duplicates(rows):
+    """Sort the index rows of a dataset by timestamp and set file_duplicate.
+
+    Every file after the first with the same MD5 hash and size is marked as a duplicate.
+    """
+    rows.sort(key=lambda r: (r["file_timestamp"], r["file_name"]))
+    seen = set()
+    for row in rows:
+        if (row["file_md5"], row["file_size"]) in seen:
+            row["file_duplicate"] = 1
+        else:
+            row["file_duplicate"] = 0
+            seen.add((row["file_md5"], row["file_size"]))
+    return rows
+
+def changeset_name(t = None):
+    """Name of an index changeset, beginning with the time of the run (UTC) so names sort in order of runs.
+
+    A random suffix keeps names of runs started in the same second unique.
+    """
+    return time.strftime("%Y-%m-%d_%H-%M-%S", time.gmtime(t)) + "_" + os.urandom(4).hex() + ".jsonl.gz"
+
+def pending_changesets(keys, applied):
+    """Return the keys of changesets not yet applied to the index, in the order they should be applied.
+
+    Parameters:
+    keys (list): S3 keys of changesets.
+    applied (set): Names of changesets already applied (the index_changesets table).
+    """
+    return sorted((k for k in keys if os.path.basename(k) not in applied), key = os.path.basename)
+
+def folded_changesets(keys, applied):
+    """Return the keys of changesets already folded into the index, which can be deleted once it is uploaded."""
+    return [k for k in keys if os.path.basename(k) in applied]
@@ -0,0 +1,77 @@
+# import modules
+import math
+import heapq
+from collections import deque
+
+# scheduling calculations used by utils.scheduler, which take the history of previous runs as arguments
+
+# define functions
+def estimate_duration(durations, workers = 1):
+    """Estimate the duration of a run by assigning datasets, in order, to the first available worker."""
+    finish = [0.0] * max(workers, 1)
+    for duration in durations:
+        heapq.heappush(finish, heapq.heappop(finish) + duration)
+    return max(finish)
+
+def order_by_history(uuids, history, workers = 1, hosts = None):
+    """Order datasets using the history of previous runs (see Archivist.load_run_history).
+
+    Datasets are ordered by their expected duration, longest first, so that slow datasets
+    (e.g., those loaded in a browser) do not run alone at the end of the run. The expected
+    duration is increased by the failure rate, moving unreliable datasets forward so their
+    retries overlap with other downloads. Datasets without history are given the median
+    duration of datasets with history. When downloading in parallel, datasets are then spread
+    across hosts: if the host of the next dataset is likely still busy (it is the host of one of
+    the last workers - 1 datasets), one of the following workers datasets is taken instead.
+
+    Parameters:
+    uuids (list): UUIDs of the datasets to order.
+    history (dict): History of previous runs, keyed by UUID.
+    workers (int): Number of datasets downloaded in parallel.
+    hosts (dict): Optional. Hosts of datasets without history, keyed by UUID.
+
+    Returns:
+    list: UUIDs in the order they should be started.
+    """
+    default = sorted(h["duration"] for h in history.values())
+    default = default[len(default) // 2] if len(default) > 0 else 0
+    def expected(uuid):
+        h = history.get(uuid)
+        return h["duration"] * (1 + h["failure_rate"]) if h is not None else default
+    def host(uuid):
+        if uuid in history:
+            return history[uuid]["host"]
+        return hosts.get(uuid) if hosts is not None else None
+    remaining = sorted(uuids, key = expected, reverse = True)
+    ordered = []
+    recent = deque(maxlen = max(workers - 1, 0))
+    while len(remaining) > 0:
+        i = next((i for i, uuid in enumerate(remaining[:max(workers, 1)]) if host(uuid) is None or host(uuid) not in recent), 0)
+        uuid = remaining.pop(i)
+        recent.append(host(uuid))
+        ordered.append(uuid)
+    return ordered
+
+def count_changes(snapshots):
+    """Count the snapshots that differ from the previous snapshot.
+
+    A file that reverts to an earlier version is a duplicate, but still a change.
+
+    Parameters:
+    snapshots (list): Tuples of timestamp and MD5 hash, in chronological order (see Archivist.load_change_history).
+    """
+    return sum(1 for previous, current in zip(snapshots, snapshots[1:]) if current[1] != previous[1])
+
+def change_probability(snapshots, now):
+    """Estimate the probability a dataset changed since its last snapshot (see utils.scheduler.skip_unchanged).
+
+    Parameters:
+    snapshots (list): Tuples of timestamp and MD5 hash, in chronological order (see Archivist.load_change_history).
+    now (float): Current time (seconds since the epoch).
+
+    Returns:
+    float: Probability of a change, assuming changes occur at the rate observed in the snapshots, plus one change.
+    """
+    span = max((snapshots[-1][0] - snapshots[0][0]) / 3600, 1)
+    hours_since = (now - snapshots[-1][0]) / 3600
+    return 1 - math.exp(-(count_changes(snapshots) + 1) / span * hours_since)
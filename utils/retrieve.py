@@ -0,0 +1,114 @@
+# import modules
+import os
+import io
+import tempfile
+
+# import classes
+from archivist.classes.Archivist import Archivist as a
+
+# import functions
+from archivist.utils.storage import apply_delta, decompress_bytes, decompress_file
+
+# define functions
+def blob_key(f_md5, f_size):
+    """S3 key (relative to the bucket root) of a content-addressed file, e.g., blobs/d4/d41d8cd98f00b204e9800998ecf8427e_0."""
+    return os.path.join("blobs", f_md5[:2], f_md5 + "_" + str(f_size))
+
+def resolve_file(file_name, uuid = None):
+    """Find where an archived file is stored.
+
+    Duplicates resolve to the first stored copy of the same file for the same dataset.
+    Files with a file_key are stored at that key (e.g., content-addressed blobs or deltas);
+    other files are stored at their original path.
+
+    Parameters:
+    file_name (str): Name of the archived file (as recorded in the index).
+    uuid (str): Optional. UUID of the dataset, if the file name is not unique.
+
+    Returns:
+    dict: The index row of the stored copy of the file, with its full S3 key as "key".
+    """
+    query = "SELECT * FROM archive WHERE file_name = ?"
+    params = [file_name]
+    if uuid is not None:
+        query += " AND uuid = ?"
+        params.append(uuid)
+    with a.index_lock:
+        rows = list(a.index.query(query, params))
+    if len(rows) == 0:
+        raise Exception("File not found in index: " + file_name)
+    if len(rows) > 1:
+        raise Exception("File name is not unique, please specify UUID: " + ", ".join(r["uuid"] for r in rows))
+    row = rows[0]
+    # find the first stored copy of a duplicate
+    if row["file_duplicate"] == 1 and row.get("file_key") is None:
+        with a.index_lock:
+            original = list(a.index.query(
+                "SELECT * FROM archive WHERE uuid = ? AND file_md5 = ? AND file_size = ? AND file_duplicate = 0 ORDER BY file_timestamp LIMIT 1",
+                [row["uuid"], row["file_md5"], row["file_size"]]))
+        if len(original) == 0:
+            raise Exception("Stored copy of duplicate file not found in index: " + file_name)
+        stored = original[0]
+    else:
+        stored = row
+    # get S3 key
+    stored = dict(stored)
+    if stored.get("file_key") is not None:
+        stored["key"] = os.path.join(a.s3["bucket_root"], stored["file_key"])
+    else:
+        d = a.ds[stored["uuid"]]
+        stored["key"] = os.path.join(a.s3["bucket_root"], d["dir_parent"], d["dir_file"], stored["file_name"])
+    return stored
+
+def read_file(row):
+    """Read the content of an archived file, decompressing it and reconstructing it from its base version if it is stored as a delta.
+
+    Parameters:
+    row (dict): Index row returned by resolve_file().
+
+    Returns:
+    bytes: Content of the file.
+    """
+    if row.get("file_offset") is not None:
+        # read file from bundle using a range request
+        byte_range = "bytes=" + str(row["file_offset"]) + "-" + str(row["file_offset"] + row["file_stored_size"] - 1)
+        data = a.s3["bucket"].meta.client.get_object(Bucket=a.s3["bucket_name"], Key=row["key"], Range=byte_range)["Body"].read()
+    else:
+        data = io.BytesIO()
+        a.s3["bucket"].download_fileobj(Fileobj=data, Key=row["key"])
+        data = data.getvalue()
+    if row.get("file_encoding") is not None:
+        data = decompress_bytes(data, row["file_encoding"])
+    if row.get("file_base") is not None:
+        # reconstruct from base version (chains are limited by keyframe_interval)
+        base = read_file(resolve_file(row["file_base"], row["uuid"]))
+        data = apply_delta(base, data)
+    return data
+
+def fetch_file(file_name, uuid = None, out_path = None):
+    """Download an archived file by its original name.
+
+    Parameters:
+    file_name (str): Name of the archived file (as recorded in the index).
+    uuid (str): Optional. UUID of the dataset, if the file name is not unique.
+    out_path (str): Optional. Output file name and path. Defaults to the file name in the working directory.
+    """
+    if out_path is None:
+        out_path = file_name
+    row = resolve_file(file_name, uuid)
+    print("Downloading " + file_name + " from " + row["key"] + "...")
+    if row.get("file_base") is not None or row.get("file_offset") is not None:
+        # reconstruct file stored as a delta or read it from a bundle
+        if row.get("file_base") is not None:
+            print("Reconstructing from " + str(row["file_chain"]) + " deltas...")
+        with open(out_path, "wb") as local_file:
+            local_file.write(read_file(row))
+    elif row.get("file_encoding") is not None:
+        # decompress file
+        tmpdir = tempfile.TemporaryDirectory()
+        c_path = os.path.join(tmpdir.name, "compressed")
+        a.s3["bucket"].download_file(Filename=c_path, Key=row["key"])
+        decompress_file(c_path, out_path, row["file_encoding"])
+    else:
+        a.s3["bucket"].download_file(Filename=out_path, Key=row["key"])
+    print("File written to: " + out_path)
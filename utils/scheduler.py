@@ -0,0 +1,171 @@
+# import modules
+import time
+import threading
+from collections import deque
+from urllib.parse import urlparse
+from humanfriendly import format_timespan
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# import classes
+from archivist.classes.Archivist import Archivist as a
+from archivist.classes.Downloader import Downloader, resolve_url
+from archivist.classes.Webdriver import WebdriverPool as wp
+from archivist.classes.Uploader import Uploader as up
+
+# import functions
+from archivist.utils.planning import estimate_duration, order_by_history, count_changes, change_probability
+
+# define functions
+def skip_unchanged(uuids):
+    """Skip datasets that are unlikely to have changed since they were last downloaded (--skip-unchanged).
+
+    The change rate of each dataset is estimated from its snapshots in the index (see
+    Archivist.load_change_history) as the number of snapshots that differ from the previous
+    snapshot per hour, plus one change, so datasets that never changed are still checked
+    eventually. Assuming changes occur at this rate, a dataset is skipped if the probability it
+    changed since its last snapshot is below skip_below (see utils.planning.change_probability).
+    Datasets with fewer than min_snapshots snapshots are never skipped and every dataset is
+    downloaded at least every max_staleness hours (can be set per dataset using the max_staleness
+    arg). These settings are in the [scheduling] section of config.toml.
+
+    Returns:
+    list: UUIDs of the datasets to download.
+    """
+    config = a.config.get("scheduling", {})
+    skip_below = config.get("skip_below", 0.05)
+    min_snapshots = config.get("min_snapshots", 10)
+    history = a.load_change_history(uuids)
+    now = time.time()
+    selected = []
+    for uuid in uuids:
+        snapshots = history.get(uuid, [])
+        if len(snapshots) < min_snapshots:
+            selected.append(uuid)
+            continue
+        max_staleness = a.catalog["info"].get(uuid, {}).get("args", {}).get("max_staleness", config.get("max_staleness", 24))
+        hours_since = (now - snapshots[-1][0]) / 3600
+        if hours_since >= max_staleness:
+            selected.append(uuid)
+            continue
+        p_change = change_probability(snapshots, now)
+        if p_change < skip_below:
+            a.record_skip(uuid, "change probability " + "%.3f" % p_change + ", " + str(count_changes(snapshots)) + " changes in " + str(len(snapshots)) + " snapshots, last downloaded " + "%.1f" % hours_since + " hours ago")
+        else:
+            selected.append(uuid)
+    return selected
+
+def plan_downloads(uuids, workers = 1):
+    """Skip unchanged datasets (--skip-unchanged), order datasets (--order history) and print the estimated duration of the run.
+
+    These use the history of previous runs recorded in the index, so they are only available
+    for prod runs (after the index is downloaded). For other runs, datasets are downloaded in
+    the order of a.ds.
+    """
+    if a.options["mode"] != "prod":
+        if a.options["order"] == "history":
+            print("History of previous runs is only available for prod runs. Downloading datasets in listed order...")
+        if a.options["skip_unchanged"]:
+            print("History of previous runs is only available for prod runs. No datasets will be skipped...")
+        return uuids
+    if a.options["skip_unchanged"]:
+        if a.options["uuid"]:
+            print("Ignoring --skip-unchanged, as --uuid is set.")
+        else:
+            n = len(uuids)
+            uuids = skip_unchanged(uuids)
+            print("Skipped " + str(n - len(uuids)) + "/" + str(n) + " datasets that are unlikely to have changed.")
+    history = a.load_run_history(uuids)
+    if a.options["order"] == "history":
+        hosts = {uuid: urlparse(a.ds[uuid]["url"]).hostname for uuid in uuids if uuid not in history and "url" in a.ds[uuid]}
+        uuids = order_by_history(uuids, history, workers, hosts)
+        print("Ordered " + str(len(uuids)) + " datasets using the history of previous runs (" + str(len(history)) + " with history).")
+    # estimate duration of the run
+    if len(history) > 0:
+        default = sorted(h["duration"] for h in history.values())[len(history) // 2]
+        durations = [history[uuid]["duration"] if uuid in history else default for uuid in uuids]
+        print("Estimated run duration: " + format_timespan(estimate_duration(durations, workers)) + " (" + str(len(history)) + "/" + str(len(uuids)) + " datasets with history).")
+    return uuids
+
+def prefetch_urls(uuids):
+    """Resolve the dynamic URLs (url_fun_python) of datasets concurrently, storing them in a.resolved_urls.
+
+    The number of parallel resolutions and the time allowed for each URL are set by prefetch_workers
+    and prefetch_timeout in the [downloading] section of config.toml. Each URL function runs in its
+    own daemon thread, so a URL function that hangs neither holds up the other URLs nor prevents
+    archivist from exiting. Its dataset waits for it (see Downloader.get_dataset_info) instead of
+    running the URL function a second time. URLs that fail or are not resolved are resolved again
+    when their dataset is downloaded.
+    """
+    uuids = [uuid for uuid in uuids if "url" not in a.ds[uuid] and "url_fun_python" in a.ds[uuid]]
+    if len(uuids) == 0:
+        return
+    config = a.config["downloading"]
+    timeout = config.get("prefetch_timeout", 60)
+    print("Resolving " + str(len(uuids)) + " dynamic URLs...")
+    t0 = time.monotonic()
+    # set when the resolution of a URL ends, whether it succeeded or not
+    for uuid in uuids:
+        a.prefetching[uuid] = threading.Event()
+    pending = deque(uuids)
+    def resolve(uuid):
+        try:
+            a.resolved_urls[uuid] = resolve_url(uuid)
+        except Exception as e:
+            print(e)
+            print(uuid + ": Failed to resolve URL in advance. It will be retried before download.")
+        finally:
+            a.prefetching[uuid].set()
+    def worker():
+        while True:
+            try:
+                uuid = pending.popleft()
+            except IndexError:
+                return
+            threading.Thread(target = resolve, args = (uuid,), daemon = True).start()
+            if not a.prefetching[uuid].wait(timeout):
+                print(uuid + ": URL was not resolved within " + str(timeout) + " seconds. It will be retried before download.")
+    workers = [threading.Thread(target = worker, daemon = True) for _ in range(min(config.get("prefetch_workers", 8), len(uuids)))]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    print("Resolved " + str(len(a.resolved_urls)) + "/" + str(len(uuids)) + " dynamic URLs in " + "%.1f" % (time.monotonic() - t0) + " seconds.")
+
+def download(uuid):
+    # a dataset that cannot be downloaded at all (e.g., an invalid entry) is recorded as a failure without stopping the run
+    try:
+        Downloader(uuid)
+    except Exception as e:
+        print(e)
+        a.record_failure(uuid, uuid)
+
+def run_downloads(uuids, workers = 1):
+    """Download datasets, optionally using a pool of worker threads.
+
+    Parameters:
+    uuids (list): UUIDs of the datasets to download, in the order they should be started.
+    workers (int): Number of datasets to download in parallel. If 1 (the default), datasets are downloaded one at a time.
+    """
+
+    try:
+        # resolve dynamic URLs concurrently, if specified
+        if a.options["prefetch"]:
+            prefetch_urls(uuids)
+
+        # download datasets one at a time
+        if workers <= 1:
+            for uuid in uuids:
+                download(uuid)
+            return
+
+        # download datasets using a pool of workers
+        # parallel requests to the same host are limited by a.host_limit() in Downloader.dl_fun()
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            futures = [executor.submit(download, uuid) for uuid in uuids]
+            for future in as_completed(futures):
+                future.result()
+    finally:
+        # wait for queued uploads, so all index entries are recorded before the index is uploaded
+        up.drain()
+        # quit browsers used for html_page datasets
+        wp.close()
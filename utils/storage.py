@@ -0,0 +1,151 @@
+# import modules
+import io
+import json
+import gzip
+import shutil
+import hashlib
+import bisect
+
+# optional dependency for zstd compression
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# format identifier of line-based deltas (lines are split on "\n" only, as when reading a file)
+DELTA_FORMAT = "archivist-delta-2"
+
+# define functions
+def make_delta(base_path, new_path, max_size = None):
+    """Create a line-based delta that transforms the file at base_path into the file at new_path.
+
+    Lines are matched by their MD5 hashes in a single pass over each file, so the time taken is
+    roughly linear in the size of the files and only the hashes of the base are kept in memory.
+    Each line of the new version continues the current copy from the base if it matches the next
+    base line, otherwise it starts a copy from the first matching base line after the end of the
+    last copy (or from the first matching base line, if there is none) or is inserted. Lines are
+    stored as latin-1 strings, so any file can be encoded without loss.
+
+    Parameters:
+    base_path (str): Path to the base version.
+    new_path (str): Path to the new version.
+    max_size (int): Optional. Give up if the inserted lines exceed this size in bytes.
+
+    Returns:
+    bytes: The delta (JSON), or None if it would exceed max_size. Each operation is either [i1, i2]
+    (copy lines i1 to i2 of base) or a string (insert these lines).
+    """
+    # hash lines of base
+    base_hashes = []
+    line_numbers = {}
+    with open(base_path, "rb") as base_file:
+        for i, line in enumerate(base_file):
+            h = hashlib.md5(line).digest()
+            base_hashes.append(h)
+            line_numbers.setdefault(h, []).append(i)
+    # match lines of new version
+    ops = []
+    inserted = []
+    inserted_size = 0
+    pos = None # next line of base continuing the current copy
+    last_end = 0 # end of the last copy
+    with open(new_path, "rb") as new_file:
+        for line in new_file:
+            h = hashlib.md5(line).digest()
+            if pos is not None and pos < len(base_hashes) and base_hashes[pos] == h:
+                # continue copy
+                ops[-1][1] += 1
+                pos += 1
+                last_end = pos
+            elif h in line_numbers:
+                # start copy
+                if len(inserted) > 0:
+                    ops.append(b"".join(inserted).decode("latin-1"))
+                    inserted = []
+                candidates = line_numbers[h]
+                i = bisect.bisect_left(candidates, last_end)
+                pos = (candidates[i] if i < len(candidates) else candidates[0]) + 1
+                last_end = pos
+                ops.append([pos - 1, pos])
+            else:
+                # insert line
+                inserted.append(line)
+                inserted_size += len(line)
+                if max_size is not None and inserted_size > max_size:
+                    return None
+                pos = None
+    if len(inserted) > 0:
+        ops.append(b"".join(inserted).decode("latin-1"))
+    return json.dumps({"format": DELTA_FORMAT, "ops": ops}, separators=(",", ":")).encode("utf-8")
+
+def apply_delta(base, delta):
+    """Reconstruct a version from its base and a delta created by make_delta().
+
+    Parameters:
+    base (bytes): Content of the base version.
+    delta (bytes): The delta.
+
+    Returns:
+    bytes: Content of the reconstructed version.
+    """
+    delta = json.loads(delta)
+    if delta.get("format") != DELTA_FORMAT:
+        raise Exception("Unknown delta format: " + str(delta.get("format")))
+    base_lines = io.BytesIO(base).readlines()
+    out = []
+    for op in delta["ops"]:
+        if isinstance(op, list):
+            out.extend(base_lines[op[0]:op[1]])
+        else:
+            out.append(op.encode("latin-1"))
+    return b"".join(out)
+
+def check_encoding(encoding):
+    # verify compression method is supported
+    if encoding not in ["gzip", "zstd"]:
+        raise Exception("Unknown compression method: " + str(encoding))
+    if encoding == "zstd" and zstandard is None:
+        raise Exception("zstd compression requires the zstandard package")
+
+def compress_file(in_path, out_path, encoding, level = None):
+    """Compress a file, reading and writing it in chunks.
+
+    Parameters:
+    in_path (str): Path to the file.
+    out_path (str): Path to the compressed file.
+    encoding (str): Compression method ("gzip" or "zstd").
+    level (int): Optional. Compression level (defaults to 6 for gzip and 3 for zstd).
+    """
+    check_encoding(encoding)
+    with open(in_path, "rb") as f_in:
+        if encoding == "gzip":
+            with gzip.open(out_path, "wb", compresslevel=6 if level is None else level) as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        else:
+            with open(out_path, "wb") as f_out:
+                zstandard.ZstdCompressor(level=3 if level is None else level).copy_stream(f_in, f_out)
+
+def decompress_file(in_path, out_path, encoding):
+    """Decompress a file created by compress_file(), reading and writing it in chunks."""
+    check_encoding(encoding)
+    with open(out_path, "wb") as f_out:
+        if encoding == "gzip":
+            with gzip.open(in_path, "rb") as f_in:
+                shutil.copyfileobj(f_in, f_out)
+        else:
+            with open(in_path, "rb") as f_in:
+                zstandard.ZstdDecompressor().copy_stream(f_in, f_out)
+
+def open_decompressed(fileobj, encoding):
+    """Wrap a file object (e.g., a streamed S3 object) compressed by compress_file(), so reading it returns the decompressed content."""
+    check_encoding(encoding)
+    if encoding == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    return zstandard.ZstdDecompressor().stream_reader(fileobj)
+
+def decompress_bytes(data, encoding):
+    """Decompress bytes compressed by compress_file()."""
+    check_encoding(encoding)
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)